@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of tmux_noc.py. Every operation is run as tmux_noc.py subcommand in a separate process, with
+fake tmux (benchmarks/fake_tmux/tmux) first in PATH and HOME set to the directory with synthetic fixtures:
+big ssh config with includes, long sessions history, deep log tree and high-rate pane output.
+For every operation number of tmux spawns, number of tmux commands, wall time and peak RSS are reported
+and compared with benchmarks/baseline.json. Exit status is 1, if any operation is worse than the baseline,
+or if it's number of tmux spawns or commands is not the same as in the baseline.
+
+    benchmarks/bench_tmux_noc.py                     # run and compare with the baseline
+    benchmarks/bench_tmux_noc.py --update-baseline   # run and save results as the new baseline
+    benchmarks/bench_tmux_noc.py noc_menu ssh_menu   # run only these operations
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+FAKE_TMUX_DIR = f'{BENCHMARKS_DIR}/fake_tmux'
+BASELINE = f'{BENCHMARKS_DIR}/baseline.json'
+
+# Fixture sizes.
+SSH_CONFIG_HOSTS = 10000
+SSH_CONFIG_FILES = 10
+HISTORY_SESSIONS = 100000
+LOG_DAYS = 100
+LOGS_PER_DAY = 10
+LOG_LINES = 100
+PANE_OUTPUT_SIZE = 20 * 1024 * 1024
+FAKE_TMUX_PANES = 200
+
+# Operation fails, if it has other number of tmux spawns or commands than the baseline, or if wall time or RSS
+# is bigger by this ratio plus absolute slack.
+WALL_TOLERANCE = (1.5, 0.2)
+RSS_TOLERANCE = (1.3, 10)
+
+
+def generate_fixtures(root):
+    """
+    Creates home directory with tmuxNOC, that uses scripts from this repository, and synthetic data.
+    """
+    random.seed(1)
+    home = f'{root}/home'
+    tmux_noc = f'{home}/tmuxNOC'
+    local = f'{tmux_noc}/local'
+    os.makedirs(local)
+    os.symlink(f'{REPO_DIR}/scripts', f'{tmux_noc}/scripts')
+    os.symlink(f'{REPO_DIR}/misc', f'{tmux_noc}/misc')
+
+    # ssh config with hosts in included files.
+    os.makedirs(f'{home}/.ssh/conf.d')
+    with open(f'{home}/.ssh/config', 'w') as f:
+        f.write('Include conf.d/*.conf\n\nHost *\n    ServerAliveInterval 30\n')
+    hosts_per_file = SSH_CONFIG_HOSTS // SSH_CONFIG_FILES
+    for file_number in range(SSH_CONFIG_FILES):
+        with open(f'{home}/.ssh/conf.d/site{file_number}.conf', 'w') as f:
+            for host_number in range(hosts_per_file):
+                f.write(f'Host sw{host_number}.site{file_number}.example.net\n'
+                        f'    HostName 10.{file_number}.{host_number // 256}.{host_number % 256}\n'
+                        f'    User noc\n')
+
+    # Sessions history: legacy history file and journal, that it's converted to.
+    start = datetime.datetime(2020, 1, 1)
+    with open(f'{local}/sessions_history.log', 'w') as history, \
+            open(f'{local}/sessions_journal.log', 'w') as journal:
+        last_date = None
+        for index in range(1, HISTORY_SESSIONS + 1):
+            started = start + datetime.timedelta(minutes=5 * index)
+            connection_type = random.choice(['ssh', 'telnet'])
+            host = f'sw{random.randrange(hosts_per_file)}.site{random.randrange(SSH_CONFIG_FILES)}.example.net'
+            date = started.strftime('%d.%m.%Y')
+            if date != last_date:
+                history.write(f'# {date}\n')
+                last_date = date
+            history.write(f'    {index} {date} {started.strftime("%H:%M:%S")} {connection_type} {host}\n')
+            journal.write(json.dumps({'index': index, 'started': started.strftime('%Y-%m-%d %H:%M:%S'),
+                                      'connection_type': connection_type, 'host': host}) + '\n')
+    with open(f'{local}/sessions.json', 'w') as f:
+        json.dump({
+            'last_session_index': HISTORY_SESSIONS,
+            'recent_sessions': {f'ssh sw{number}.site0.example.net': [number, 1600000000 + number, 1.0]
+                                for number in range(500)},
+            'last_ssh_session': 'sw1.site0.example.net',
+        }, f)
+
+    # Log tree: log/YYYY/MM/DD/HH_MM_SS---!index_type_host.log
+    words = ['interface', 'GigabitEthernet0/1', 'description', 'uplink', 'shutdown', 'vlan', 'ip', 'address',
+             'show', 'running-config', 'error', 'down', 'up', 'bgp', 'neighbor', 'route-map']
+    session_index = 0
+    for day in range(LOG_DAYS):
+        date = start + datetime.timedelta(days=day)
+        directory = f'{local}/log/{date.strftime("%Y/%m/%d")}'
+        os.makedirs(directory)
+        for log_number in range(LOGS_PER_DAY):
+            session_index += 1
+            with open(f'{directory}/{log_number:02}_00_00---!{session_index}_s_sw{log_number}.log', 'w') as f:
+                for _ in range(LOG_LINES):
+                    f.write('R1# ' + ' '.join(random.choice(words) for _ in range(8)) + '\n')
+
+    # Pane output with colors, carriage returns and backspaces.
+    chunk = []
+    for number in range(2000):
+        chunk.append(f'\x1b[32mline {number}\x1b[0m {" ".join(random.choice(words) for _ in range(6))}\r\n')
+        if number % 10 == 0:
+            chunk.append('progress 10%\rprogress 100%\r\n')
+        if number % 17 == 0:
+            chunk.append('R1# show runx\x08 \x08\r\n')
+    chunk = ''.join(chunk).encode()
+    with open(f'{root}/pane_output', 'wb') as f:
+        for _ in range(PANE_OUTPUT_SIZE // len(chunk) + 1):
+            f.write(chunk)
+    return home
+
+
+# Operations: name: (tmux_noc.py arguments, stdin file relative to fixtures root or None, uses control mode).
+OPERATIONS = {
+    'noc_menu': (['noc_menu', '--split_direction', 'new'], None, False),
+    'noc_menu_control': (['noc_menu', '--split_direction', 'new'], None, True),
+    'ssh_menu': (['ssh_menu', '--split_direction', 'new'], None, False),
+    'connect_ssh': (['connect_ssh', '--host', 'sw1.site1.example.net', '--split_direction', 'new'], None, False),
+    'connect_ssh_control': (['connect_ssh', '--host', 'sw1.site1.example.net', '--split_direction', 'new'],
+                            None, True),
+    'rename_windows': (['rename_windows'], None, False),
+    'save_pane_history': (['save_pane_history', '--file_name', '{root}/pane.log', '-i', '-'], 'pane_output',
+                          False),
+    'sessions_history': (['sessions_history'], None, False),
+    'rebuild_log_index': (['rebuild_log_index'], None, False),
+    'search_logs': (['search_logs'], 'search_queries', False),
+    'grep_logs': (['grep_logs', '--query', 'neighbor.*route-map'], None, False),
+}
+
+
+def run_operation(name, root, home, latency):
+    """
+    Runs operation in a separate process. Returns dict with results.
+    """
+    args, stdin_name, control = OPERATIONS[name]
+    tmux_log = f'{root}/tmux_{name}.log'
+    if os.path.exists(tmux_log):
+        os.remove(tmux_log)
+    env = dict(os.environ)
+    env.update({
+        'HOME': home,
+        'PATH': f'{FAKE_TMUX_DIR}:{env.get("PATH", "")}',
+        'FAKE_TMUX_LOG': tmux_log,
+        'FAKE_TMUX_LATENCY': str(latency),
+        'FAKE_TMUX_PANES': str(FAKE_TMUX_PANES),
+    })
+    env.pop('TMUX_PANE', None)
+    if control:
+        # Server pid must be alive: this process.
+        env['TMUX'] = f'/tmp/fake-tmux,{os.getpid()},0'
+    else:
+        env.pop('TMUX', None)
+    command = [sys.executable, f'{REPO_DIR}/scripts/tmux_noc.py'] + [arg.format(root=root) for arg in args]
+    stdin = open(f'{root}/{stdin_name}', 'rb') if stdin_name else subprocess.DEVNULL
+    started = time.monotonic()
+    try:
+        process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                   env=env)
+        stderr = process.stderr.read()
+        # wait4 gives resources of this process only, not of all children.
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    finally:
+        if stdin_name:
+            stdin.close()
+    wall = time.monotonic() - started
+    spawns = commands = 0
+    if os.path.exists(tmux_log):
+        with open(tmux_log) as f:
+            for line in f:
+                entry = json.loads(line)
+                spawns += 'spawn' in entry
+                commands += 'command' in entry
+    if process.returncode != 0:
+        print(f'{name} failed:\n{stderr.decode(errors="replace")}', file=sys.stderr)
+    return {
+        'spawns': spawns,
+        'commands': commands,
+        'wall': round(wall, 3),
+        # ru_maxrss is in kilobytes on Linux.
+        'rss_mb': round(rusage.ru_maxrss / 1024, 1),
+        'ok': process.returncode == 0,
+    }
+
+
+def regressions(result, baseline):
+    """
+    Returns list of what is worse than the baseline. Numbers of tmux spawns and commands don't depend
+    on the machine, so they must be exactly the same: fewer means, that baseline is out of date and
+    would not catch the way back.
+    """
+    worse = []
+    for key in ('spawns', 'commands'):
+        if result[key] > baseline[key]:
+            worse.append(f'{key} {baseline[key]} -> {result[key]}')
+        elif result[key] < baseline[key]:
+            worse.append(f'{key} {baseline[key]} -> {result[key]}, update baseline')
+    for key, (ratio, slack) in (('wall', WALL_TOLERANCE), ('rss_mb', RSS_TOLERANCE)):
+        if result[key] > baseline[key] * ratio + slack:
+            worse.append(f'{key} {baseline[key]} -> {result[key]}')
+    if not result['ok']:
+        worse.append('failed')
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of tmux_noc.py with fake tmux.')
+    parser.add_argument('operations', nargs='*', help=f'operations to run, all by default: {", ".join(OPERATIONS)}')
+    parser.add_argument('--update-baseline', action='store_true', help='save results as the new baseline')
+    parser.add_argument('--latency', type=float, default=1, help='fake tmux latency per command, ms')
+    parser.add_argument('--keep', action='store_true', help='keep fixtures directory')
+    args = parser.parse_args()
+    operations = args.operations or list(OPERATIONS)
+    unknown = [name for name in operations if name not in OPERATIONS]
+    if unknown:
+        parser.error(f'unknown operations: {", ".join(unknown)}')
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    root = tempfile.mkdtemp(prefix='tmux_noc_bench_')
+    try:
+        print(f'Generating fixtures in {root}...')
+        home = generate_fixtures(root)
+        with open(f'{root}/search_queries', 'w') as f:
+            f.write('neighbor route-map\nhost:sw1 bgp\n')
+
+        print(f'{"operation":<22}{"spawns":>8}{"commands":>10}{"wall, s":>10}{"rss, MB":>10}')
+        results = {}
+        failed = False
+        for name in operations:
+            result = run_operation(name, root, home, args.latency)
+            results[name] = result
+            worse = regressions(result, baseline[name]) if name in baseline and not args.update_baseline else []
+            failed = failed or bool(worse) or not result['ok']
+            print(f'{name:<22}{result["spawns"]:>8}{result["commands"]:>10}{result["wall"]:>10}'
+                  f'{result["rss_mb"]:>10}  {"FAIL: " + ", ".join(worse) if worse else ""}')
+    finally:
+        if args.keep:
+            print(f'Fixtures are kept in {root}')
+        else:
+            shutil.rmtree(root)
+
+    if args.update_baseline:
+        baseline.update({name: {key: value for key, value in result.items() if key != 'ok'}
+                         for name, result in results.items()})
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+            f.write('\n')
+        print(f'Baseline is saved to {BASELINE}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Thin client for tmux_noc.py. If tmux_noc.py daemon is running, subcommand is sent to it through unix
+socket, so there is no need to start the main script and parse all the files again. If daemon is not
+running or can't run the subcommand, tmux_noc.py is started as usual.
+Only modules, that are needed for this, are imported, to keep startup time low.
+"""
+import json
+import os
+import socket
+import sys
+
+home = os.path.expanduser('~')
+script = f'{home}/tmuxNOC/scripts/tmux_noc.py'
+daemon_socket = f'{home}/tmuxNOC/local/tmux_noc.sock'
+
+
+def send_to_daemon(argv):
+    """
+    Returns daemon response or None, if daemon is not running.
+    """
+    request = {
+        'argv': argv,
+        'env': {name: os.environ[name] for name in ('TMUX', 'TMUX_PANE') if name in os.environ},
+    }
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(daemon_socket)
+    except OSError:
+        client.close()
+        return None
+    # tmux waits for us, so don't wait forever, if daemon is stuck.
+    client.settimeout(30)
+    with client, client.makefile('rwb') as stream:
+        stream.write(json.dumps(request).encode() + b'\n')
+        stream.flush()
+        return json.loads(stream.readline())
+
+
+if __name__ == "__main__":
+    try:
+        response = send_to_daemon(sys.argv[1:])
+    except (OSError, ValueError):
+        print('tmuxNOC daemon did not respond.')
+        sys.exit(1)
+    if response is None or response.get('fallback'):
+        os.execv(sys.executable, [sys.executable, script] + sys.argv[1:])
+    sys.stdout.write(response['output'])
+    sys.exit(response['status'])
@@ -8,6 +8,33 @@ from pathlib import Path
 import os
 from errno import EEXIST
 import sys
+import re
+import select
+import signal
+import socket
+import io
+import contextlib
+import copy
+import threading
+import queue
+import atexit
+import sqlite3
+import gzip
+import shutil
+import concurrent.futures
+import collections
+import fcntl
+import heapq
+import bisect
+import itertools
+import math
+import glob
+import fnmatch
+import shlex
+import termios
+import tty
+import asyncio
+import hashlib
 
 
 class ANSIColors:
@@ -31,11 +58,87 @@ class lPaths:
     home = str(Path.home())
     tmuxNOC = f'{home}/tmuxNOC'
     script = f'{tmuxNOC}/scripts/tmux_noc.py'
+    client = f'{tmuxNOC}/scripts/noc_client.py'
     paste = f'{tmuxNOC}/scripts/paste.sh'
     log_dir = f'{tmuxNOC}/local/log'
     sessions_metadata = f'{tmuxNOC}/local/sessions.json'
     sessions_history = f'{tmuxNOC}/local/sessions_history.log'
+    sessions_journal = f'{tmuxNOC}/local/sessions_journal.log'
+    sessions_lock = f'{tmuxNOC}/local/.sessions.lock'
     logins = f'{tmuxNOC}/local/.logins'
+    settings = f'{tmuxNOC}/local/settings.json'
+    daemon_socket = f'{tmuxNOC}/local/tmux_noc.sock'
+    log_index = f'{tmuxNOC}/local/log_index.db'
+    log_search = f'{tmuxNOC}/local/log_search.db'
+    ssh_config = f'{home}/.ssh/config'
+    inventory = f'{tmuxNOC}/local/inventory.txt'
+    trace = f'{tmuxNOC}/local/trace.jsonl'
+    menus = f'{tmuxNOC}/local/menus'
+    reachability = f'{tmuxNOC}/local/reachability.json'
+    ssh_control = f'{tmuxNOC}/local/ssh_cm'
+    snapshots = f'{tmuxNOC}/local/snapshots'
+
+
+DEFAULT_SETTINGS = {
+    # Pane log is written to disk, when this much bytes is buffered or after this many seconds.
+    'log_flush_size': 64 * 1024,
+    'log_flush_interval': 1,
+    # Every line of new pane logs starts with [YYYY-MM-DD HH:MM:SS] of the time it came, and time index is
+    # written next to the log, so log can be opened at some time: open_log --at HH:MM:SS.
+    'log_timestamps': False,
+    # How many lines search in logs shows for one query.
+    'search_limit': 200,
+    # Logs from previous days are compressed with zstd or gzip. zstd is used only if it's installed.
+    'log_compression': 'zstd',
+    # Logs older than this many days are deleted, 0 to keep all logs.
+    'log_retention_days': 0,
+    # The oldest logs are deleted, when all logs take more than this many megabytes, 0 for no limit.
+    'log_max_size_mb': 0,
+    # How often daemon runs logs compaction, in seconds.
+    'log_compact_interval': 6 * 60 * 60,
+    # How many recent sessions are shown in tmuxNOC menu, and how many are kept in sessions metadata.
+    'recent_sessions_menu': 5,
+    'recent_sessions_keep': 500,
+    # Weight of a connection is halved after this many days, so often and recently used hosts are first.
+    'recent_sessions_half_life_days': 7,
+    # How many hosts are shown on one page of SSH Config Hosts menu. Bigger configs are grouped by domain.
+    'ssh_menu_page_size': 30,
+    # How many seconds to wait for the device prompt, e.g. for password prompt after login is sent.
+    'prompt_timeout': 5,
+    # Run Commands on Hosts: how many hosts are worked with at once and how long to wait for the first prompt.
+    'run_concurrency': 10,
+    'connect_timeout': 30,
+    # Bulk Connect puts this many hosts in one window.
+    'bulk_panes_per_window': 4,
+    # Write timings of subcommands, tmux commands and file reads to local/trace.jsonl, see stats subcommand.
+    # Can be turned on with TMUX_NOC_TRACE=1 environment variable too. Trace file is rotated at trace_max_size.
+    'trace': False,
+    'trace_max_size': 5 * 1024 * 1024,
+    # Daemon checks every probe_interval seconds, if recent and ssh config hosts accept TCP connection on
+    # ssh or telnet port, and menus show the result. 0 to not check. Results older than probe_ttl are not
+    # shown. probe_max_hosts limits how many hosts are checked, recent hosts are checked first.
+    'probe_interval': 60,
+    'probe_timeout': 2,
+    'probe_concurrency': 50,
+    'probe_ttl': 300,
+    'probe_max_hosts': 500,
+    # ssh connections to the same host share one connection (OpenSSH ControlMaster), so reconnect doesn't
+    # do handshake and authentication again. Master is closed, when it has no sessions for
+    # ssh_control_persist seconds. Not more than ssh_max_masters masters are kept.
+    'ssh_multiplexing': False,
+    'ssh_control_persist': 600,
+    'ssh_max_masters': 20,
+    # Daemon saves snapshot of all windows and connections this often, seconds. 0 turns it off.
+    'snapshot_interval': 60,
+}
+
+# Escape sequences: CSI, OSC, DCS/PM/APC strings and two/three byte sequences.
+ANSI_ESCAPE_RE = re.compile(
+    rb'\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)|[PX^_][^\x1b]*\x1b\\|[ -/]*[0-~])'
+)
+# Escape sequence, that may be not complete yet at the end of the chunk.
+ANSI_ESCAPE_TAIL_RE = re.compile(rb'\x1b(?:\[[0-?]*[ -/]*|\][^\x07\x1b]*\x1b?|[PX^_][^\x1b]*\x1b?|[ -/]*)$')
+CONTROL_CHARS_RE = re.compile(rb'[\x00-\x07\x0b-\x1f\x7f]')
 
 
 def create_dir(filename):
@@ -50,279 +153,2341 @@ def create_dir(filename):
                 raise
 
 
+# Parsed files, so resident daemon doesn't read and parse them on every request.
+# {path: (mtime_ns, size, parsed_content)}
+files_cache = {}
+
+
+def read_cached(filename, parser):
+    """
+    Returns parser(file_object) result. File is parsed again only if it's mtime, size or inode is changed
+    (inode changes, when file is replaced atomically).
+    """
+    stat = os.stat(filename)
+    key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    cached = files_cache.get(filename)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    with trace_span('read', os.path.basename(filename)), open(filename, 'r') as f:
+        content = parser(f)
+    files_cache[filename] = (key, content)
+    return content
+
+
+# Commands, that are shown on the client: from control mode client they need explicit target client.
+TMUX_CLIENT_COMMANDS = {
+    'display-menu': '-c',
+    'menu': '-c',
+    'display-message': '-c',
+    'display': '-c',
+    'command-prompt': '-t',
+    'display-popup': '-c',
+    'popup': '-c',
+}
+TMUX_SAFE_ARGUMENT_RE = re.compile(r'^[\w@%:./=,+-]+$')
+
+
+def tmux_quote(argument):
+    """
+    Quote argument for tmux command parser.
+    """
+    if TMUX_SAFE_ARGUMENT_RE.match(argument):
+        return argument
+    return "'" + argument.replace("'", "'\"'\"'") + "'"
+
+
+class TmuxSubprocess:
+    """
+    Runs every tmux command in a separate tmux client process.
+    """
+    closed = False
+
+    def run(self, args):
+        with trace_span('spawn', 'tmux'):
+            return subprocess.check_output(['tmux'] + list(args), encoding='UTF-8')
+
+    def run_many(self, commands):
+        """
+        Runs commands as one ';' separated command list in one tmux client.
+        """
+        args = []
+        for command in commands:
+            if args:
+                args.append(';')
+            args += command
+        return [self.run(args)]
+
+    def reset_context(self):
+        pass
+
+
+class TmuxControl:
+    """
+    One tmux client in control mode (tmux -C), that is used for all commands. Commands are written
+    to it's stdin line by line, replies are read from %begin/%end (%error) blocks, so several commands
+    can be sent before waiting for the replies. Notifications are read in a separate thread.
+    Client stays attached to the session, while it's used, so it's in list-clients, and session with it is
+    attached even if no user is. Pane output is not sent to it (no-output flag), unless someone listens to it.
+    """
+    def __init__(self, tmux_env):
+        socket_path, _, session_id = tmux_env.split(',')[:3]
+        attach = ['tmux', '-S', socket_path, '-C', 'attach-session', '-f', 'ignore-size,no-output']
+        self.session = None
+        if session_id not in ('', '-1'):
+            self.session = f'${session_id}'
+            attach += ['-t', self.session]
+        env = dict(os.environ)
+        env.pop('TMUX', None)
+        with trace_span('spawn', 'tmux -C'):
+            self.process = subprocess.Popen(
+                attach, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env
+            )
+            self.replies = queue.Queue()
+            self.lock = threading.Lock()
+            self.attached = threading.Event()
+            self.closed = False
+            self.client = None
+            # Pane output listeners {pane_id: [PaneOutput]}. Dict is replaced, not changed, so reader can use
+            # it without lock.
+            self.outputs = {}
+            self.outputs_lock = threading.Lock()
+            self.reader = threading.Thread(target=self.read_notifications, daemon=True)
+            self.reader.start()
+            if not self.attached.wait(1):
+                self.close()
+
+    def read_notifications(self):
+        block, block_number = None, None
+        for raw_line in self.process.stdout:
+            if block is None and self.outputs and raw_line.startswith(b'%output '):
+                pane_id, _, data = raw_line[8:].rstrip(b'\n').partition(b' ')
+                for output in self.outputs.get(pane_id.decode(), ()):
+                    output.feed(TMUX_OUTPUT_ESCAPE_RE.sub(lambda match: bytes([int(match.group(1), 8)]), data))
+                continue
+            line = raw_line.decode('UTF-8', errors='replace').rstrip('\n')
+            if block is not None:
+                guard = line.split(' ')
+                if guard[0] in ('%end', '%error') and len(guard) == 4 and guard[2] == block_number:
+                    # Flags 1 means, that command was sent by us, not the attach-session command itself.
+                    if guard[3] == '1':
+                        self.replies.put((guard[0] == '%end', block))
+                    block = None
+                else:
+                    block.append(line)
+            elif line.startswith('%begin '):
+                block, block_number = [], line.split(' ')[2]
+            elif line.startswith('%session-changed '):
+                self.attached.set()
+            elif line.startswith('%exit'):
+                break
+        self.closed = True
+        self.attached.set()
+        self.replies.put(None)
+
+    def send(self, commands):
+        lines = ''.join(' '.join(tmux_quote(argument) for argument in command) + '\n' for command in commands)
+        self.process.stdin.write(lines.encode('UTF-8'))
+        self.process.stdin.flush()
+
+    def receive(self, command):
+        reply = self.replies.get()
+        if reply is None:
+            raise subprocess.CalledProcessError(1, ['tmux'] + list(command), 'tmux control client exited')
+        ok, lines = reply
+        output = '\n'.join(lines) + '\n' if lines else ''
+        if not ok:
+            raise subprocess.CalledProcessError(1, ['tmux'] + list(command), output)
+        return output
+
+    def run(self, args):
+        return self.run_many([args])[0]
+
+    def run_many(self, commands):
+        """
+        Sends all commands at once and then reads their replies.
+        """
+        commands = [self.add_target_client(list(command)) for command in commands]
+        if any('\n' in argument for command in commands for argument in command):
+            # Command is sent as a single line, new line can't be quoted.
+            return [TmuxSubprocess().run(command) for command in commands]
+        with self.lock:
+            if self.closed:
+                raise subprocess.CalledProcessError(1, ['tmux'] + commands[0], 'tmux control client exited')
+            self.send(commands)
+            return [self.receive(command) for command in commands]
+
+    def add_target_client(self, command):
+        """
+        Commands from control client are shown on the client of the same session, that is not control client
+        and was active the last.
+        """
+        flag = TMUX_CLIENT_COMMANDS.get(command[0])
+        if flag is None or flag in command or (command[0] in ('display-message', 'display') and '-p' in command):
+            return command
+        if self.client is None:
+            with self.lock:
+                session = ['-t', self.session] if self.session else []
+                self.send([['list-clients', *session, '-F',
+                            '#{client_activity} #{client_control_mode} #{client_name}']])
+                clients = self.receive(['list-clients']).split('\n')[:-1]
+            clients = [client.split(' ', 2) for client in clients]
+            clients = sorted((int(client[0]), client[2]) for client in clients if client[1] != '1')
+            self.client = clients[-1][1] if clients else ''
+        if self.client:
+            return [command[0], flag, self.client] + command[1:]
+        return command
+
+    def reset_context(self):
+        """
+        Client, that user is working with, could be changed. It's resolved again on the next command.
+        """
+        self.client = None
+
+    def add_output_listener(self, pane_id, output):
+        """
+        Pane output from %output notifications will be fed to output. Only panes of attached session are seen.
+        Client gets pane output only while there are listeners.
+        """
+        with self.outputs_lock:
+            outputs = dict(self.outputs)
+            outputs[pane_id] = outputs.get(pane_id, []) + [output]
+            first, self.outputs = not self.outputs, outputs
+        if first:
+            self.run(['refresh-client', '-f', '!no-output'])
+
+    def remove_output_listener(self, pane_id, output):
+        with self.outputs_lock:
+            outputs = dict(self.outputs)
+            outputs[pane_id] = [listener for listener in outputs.get(pane_id, []) if listener is not output]
+            if not outputs[pane_id]:
+                del outputs[pane_id]
+            self.outputs = outputs
+        if not outputs and not self.closed:
+            try:
+                self.run(['refresh-client', '-f', 'no-output'])
+            except subprocess.CalledProcessError:
+                pass
+
+    def close(self):
+        self.closed = True
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+
+# Characters in %output notifications, that are escaped as backslash and three octal digits.
+TMUX_OUTPUT_ESCAPE_RE = re.compile(rb'\\([0-7]{3})')
+
+
+class PaneOutput:
+    """
+    New output of the pane, for waiting for prompts. Output is received with %output notifications from
+    control mode client, so pattern is matched as soon as output arrives. Without control mode client
+    pane content is polled with capture-pane and pattern is matched in the last line.
+    Only the last size bytes of output are kept.
+    """
+    def __init__(self, pane_id, streaming, size=4096):
+        self.pane_id = pane_id
+        self.streaming = streaming
+        self.size = size
+        self.buffer = b''
+        self.matched_screen = None
+        self.condition = threading.Condition()
+
+    def feed(self, data):
+        with self.condition:
+            self.buffer = (self.buffer + data)[-self.size:]
+            self.condition.notify_all()
+
+    def text(self):
+        """
+        Returns output without escape sequences and control characters.
+        """
+        return CONTROL_CHARS_RE.sub(b'', ANSI_ESCAPE_RE.sub(b'', self.buffer)).decode('UTF-8', errors='replace')
+
+    def wait_for(self, pattern, timeout):
+        """
+        Waits for regular expression (string or compiled) in the output. Returns matched text or None after
+        timeout seconds. Output before the match is dropped, so next wait sees only output after it.
+        """
+        match = self.wait_for_match(pattern, timeout)
+        return None if match is None else match.group(0)
+
+    def wait_for_match(self, pattern, timeout):
+        """
+        The same as wait_for, but returns match object.
+        """
+        if isinstance(pattern, str):
+            pattern = re.compile(pattern)
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.streaming:
+                with self.condition:
+                    match = pattern.search(self.text())
+                    if match is not None:
+                        self.buffer = b''
+                        return match
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    self.condition.wait(remaining)
+            else:
+                screen = tmux('capture-pane', '-J', '-p', '-t', self.pane_id).split('\n')
+                screen = [line for line in screen if line][-2:]
+                # Prompt is the last line. Screen, that was already matched, is not matched again.
+                if screen and screen != self.matched_screen:
+                    match = pattern.search(screen[-1])
+                    if match is not None:
+                        self.matched_screen = screen
+                        return match
+                if time.monotonic() >= deadline:
+                    return None
+                time.sleep(0.1)
+
+
+@contextlib.contextmanager
+def watch_pane_output(pane_id):
+    """
+    Yields PaneOutput, that receives pane output until the end of with block. Start watching before sending
+    something to the pane, so the reply is not missed.
+    """
+    transport = get_tmux_transport()
+    if isinstance(transport, TmuxControl):
+        output = PaneOutput(pane_id, streaming=True)
+        transport.add_output_listener(pane_id, output)
+        try:
+            yield output
+        finally:
+            transport.remove_output_listener(pane_id, output)
+    else:
+        yield PaneOutput(pane_id, streaming=False)
+
+
+# tmux clients that are used for commands. {TMUX environment variable: TmuxControl}
+tmux_transports = {}
+
+
+def get_tmux_transport():
+    """
+    Returns control mode client for tmux server and session from TMUX environment variable. If we are
+    not inside tmux or control mode client can't be started, commands are run with subprocess.
+    """
+    tmux_env = os.environ.get('TMUX')
+    if not tmux_env:
+        return TmuxSubprocess()
+    transport = tmux_transports.get(tmux_env)
+    if transport is None or transport.closed:
+        try:
+            transport = TmuxControl(tmux_env)
+        except (OSError, ValueError):
+            transport = None
+        if transport is None or transport.closed:
+            transport = TmuxSubprocess()
+        tmux_transports[tmux_env] = transport
+    return transport
+
+
+@atexit.register
+def close_tmux_transports():
+    for transport in tmux_transports.values():
+        if isinstance(transport, TmuxControl):
+            transport.close()
+
+
+def tmux(*args):
+    """
+    Run tmux command. Returns it's output.
+    """
+    with trace_span('tmux', args[0] if args else ''):
+        return get_tmux_transport().run(args)
+
+
+def tmux_batch(commands):
+    """
+    Run several tmux commands in one go.
+    """
+    if commands:
+        with trace_span('tmux', 'batch'):
+            get_tmux_transport().run_many(commands)
+
+
+def tmux_batch_output(commands):
+    """
+    Run several tmux commands in one go and return their output. Without control mode client output
+    of all commands is returned as one string, so join the list before using it.
+    """
+    if not commands:
+        return []
+    with trace_span('tmux', 'batch'):
+        return get_tmux_transport().run_many(commands)
+
+
 def get_split_command(split_direction):
     """
     What commands to use in what situation.
     """
     if split_direction == 'vertical':
-        return ['tmux', 'split-window', '-v']
+        return ['split-window', '-v']
     elif split_direction == 'horizontal':
-        return ['tmux', 'split-window', '-h']
+        return ['split-window', '-h']
     elif split_direction == 'reopen':
-        return ['tmux', 'respawn-pane', '-k']
+        return ['respawn-pane', '-k']
+    else:
+        return ['new-window']
+
+
+def load_settings():
+    """
+    Returns settings from local/settings.json merged with defaults.
+    """
+    settings = dict(DEFAULT_SETTINGS)
+    if os.path.exists(lPaths.settings):
+        settings.update(read_cached(lPaths.settings, json.load))
+    return settings
+
+
+# Tracing state: enabled is None, until it's checked for the current subcommand. Spans are collected in
+# memory and written to the trace file at the end of subcommand.
+trace_state = {'enabled': None, 'spans': []}
+
+
+def tracing_enabled():
+    if trace_state['enabled'] is None:
+        # Settings are read with tracing off, so reading them doesn't check tracing again.
+        trace_state['enabled'] = False
+        trace_state['enabled'] = (os.environ.get('TMUX_NOC_TRACE', '') not in ('', '0')
+                                  or bool(load_settings()['trace']))
+    return trace_state['enabled']
+
+
+@contextlib.contextmanager
+def trace_span(kind, name):
+    """
+    Measures time of the with block, if tracing is enabled. Kinds: command, tmux, read, spawn, startup.
+    """
+    if not tracing_enabled():
+        yield
+        return
+    started = time.time()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace_state['spans'].append({
+            'ts': round(started, 6),
+            'kind': kind,
+            'name': name,
+            'ms': round((time.perf_counter() - start) * 1000, 3),
+            'pid': os.getpid(),
+        })
+
+
+def trace_startup():
+    """
+    Adds span with time from the start of the process to this moment: Python startup and imports.
+    Process start time is read from /proc, so it works only on Linux.
+    """
+    if not tracing_enabled():
+        return
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return
+    elapsed = max(uptime - start_ticks / os.sysconf('SC_CLK_TCK'), 0)
+    trace_state['spans'].append({
+        'ts': round(time.time() - elapsed, 6),
+        'kind': 'startup',
+        'name': 'python',
+        'ms': round(elapsed * 1000, 3),
+        'pid': os.getpid(),
+    })
+
+
+def flush_trace():
+    """
+    Appends collected spans to the trace file. Trace file is renamed to trace.jsonl.1, when it's too big.
+    """
+    spans, trace_state['spans'] = trace_state['spans'], []
+    if not spans:
+        return
+    create_dir(lPaths.trace)
+    try:
+        if os.path.getsize(lPaths.trace) > load_settings()['trace_max_size']:
+            os.replace(lPaths.trace, f'{lPaths.trace}.1')
+    except OSError:
+        pass
+    with open(lPaths.trace, 'a') as f:
+        f.write(''.join(json.dumps(span) + '\n' for span in spans))
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    return values[max(math.ceil(len(values) * percent / 100) - 1, 0)]
+
+
+def trace_stats():
+    """
+    Prints count, p50, p95, max and total time of every traced operation, from trace file and rotated file.
+    """
+    durations = {}
+    for filename in (f'{lPaths.trace}.1', lPaths.trace):
+        if not os.path.exists(filename):
+            continue
+        with open(filename, 'r') as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    continue
+                durations.setdefault((span['kind'], span['name']), []).append(span['ms'])
+    if not durations:
+        print(f'No trace. Set "trace": true in {lPaths.settings} or TMUX_NOC_TRACE=1 environment variable.')
+        return
+    print(f'{"kind":<9}{"name":<32}{"count":>7}{"p50, ms":>10}{"p95, ms":>10}{"max, ms":>10}{"total, s":>10}')
+    for (kind, name), values in sorted(durations.items(), key=lambda item: (item[0][0], -sum(item[1]))):
+        values.sort()
+        print(f'{kind:<9}{name[:31]:<32}{len(values):>7}{percentile(values, 50):>10.2f}'
+              f'{percentile(values, 95):>10.2f}{values[-1]:>10.2f}{sum(values) / 1000:>10.2f}')
+
+
+# Time index of the log has an entry "unix_time byte_offset line_number" not more often than this many seconds.
+LOG_TIME_INDEX_INTERVAL = 10
+LOG_TIMESTAMP_RE = re.compile(rb'^\[(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\] ')
+# Device prompt, that waits for input: R1#, R1(config)#, user@host:~$, [user@host ~]$, [admin@MikroTik] >
+LOG_PROMPT_RE = re.compile(rb'^(?:\[[^\]\n]{1,64}\] ?)?\S{0,64}[>#$%\]] ?$')
+# Files next to the log: time index and command index.
+LOG_TIME_INDEX = '.tidx'
+LOG_COMMAND_INDEX = '.cidx'
+
+
+class PaneLogWriter:
+    """
+    Appends pane output to the log file. Escape sequences and control characters are removed, carriage
+    return and backspace are applied to the current line. Output is buffered in memory and written, when
+    buffer is bigger than flush_size or flush_interval has passed. Memory usage is bounded by flush_size.
+    With timestamps, lines are prefixed with the time their first character came, and sparse time index
+    is appended to the time index file (see log_sidecar_filename) on every flush.
+    Commands are found in the same pass: device prompt, that was left waiting for input at the end of
+    the output, is remembered, and the next line, that starts with this prompt, is a command. Command
+    index gets json line {"time", "prompt", "command", "start", "output"} for every command: offsets
+    of the command line and of it's output. Output ends where the next command starts.
+    Incomplete last line, e.g. prompt, is written on flush by time, the rest of it is written, when it's complete.
+    """
+    def __init__(self, file_name, flush_size, flush_interval, timestamps=False):
+        # Empty day directory may be removed by compact_logs after the log name was made, e.g. after midnight.
+        create_dir(file_name)
+        self.file = open(file_name, 'ab')
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.buffer = bytearray()
+        self.line = bytearray()
+        self.tail = b''
+        self.last_flush = time.monotonic()
+        self.timestamps = timestamps
+        self.time_index_file = open(log_sidecar_filename(file_name, LOG_TIME_INDEX), 'a') if timestamps else None
+        self.time_index = []
+        self.last_time_index = 0
+        self.command_index_file = None
+        self.command_index = []
+        self.prompt = None
+        # Log offset of the buffer start, number of written lines, line time and if the next written byte
+        # starts a line.
+        self.offset = self.file.seek(0, os.SEEK_END)
+        self.lines = count_log_lines(file_name, self.offset) if timestamps else 0
+        self.line_time = None
+        self.line_start = True
+        self.prefix_second = None
+        self.prefix = b''
+        # Beginning of the current line, that is already written, it's log offset and line_start before it.
+        self.partial = b''
+        self.partial_offset = 0
+        self.partial_line_start = True
+
+    def feed(self, data):
+        data = self.tail + data
+        self.tail = b''
+        escape_tail = ANSI_ESCAPE_TAIL_RE.search(data)
+        if escape_tail is not None and len(data) - escape_tail.start() < 256:
+            data, self.tail = data[:escape_tail.start()], data[escape_tail.start():]
+        if data.endswith(b'\r'):
+            data, self.tail = data[:-1], b'\r' + self.tail
+        data = ANSI_ESCAPE_RE.sub(b'', data)
+        data = re.sub(rb'\r+\n', b'\n', data)
+
+        pieces = data.split(b'\n')
+        now = time.time()
+        for index, piece in enumerate(pieces):
+            if b'\r' in piece:
+                self.line.clear()
+                piece = piece[piece.rfind(b'\r') + 1:]
+            if piece and self.line_time is None:
+                self.line_time = now
+            self.append_to_line(piece)
+            if index + 1 < len(pieces):
+                self.write_line(bytes(self.line) + b'\n')
+                self.line.clear()
+        if len(self.line) > self.flush_size:
+            self.write_line(bytes(self.line))
+            self.line.clear()
+        elif self.line and len(self.line) <= 128 and LOG_PROMPT_RE.match(self.line):
+            self.prompt = bytes(self.line)
+        self.flush_if_due()
+
+    def append_to_line(self, piece):
+        if b'\x08' in piece:
+            for part_index, part in enumerate(piece.split(b'\x08')):
+                if part_index != 0 and len(self.line) != 0:
+                    del self.line[-1]
+                self.line += CONTROL_CHARS_RE.sub(b'', part)
+        else:
+            self.line += CONTROL_CHARS_RE.sub(b'', piece)
+
+    def write_line(self, line, complete=True):
+        partial, self.partial = self.partial, b''
+        if partial and not line.startswith(partial):
+            # Written beginning was changed, e.g. with carriage return, line is written again as a new line.
+            self.buffer += b'\n'
+            self.line_start = True
+            self.lines += 1
+            partial = b''
+        if partial:
+            line_offset, line_start = self.partial_offset, self.partial_line_start
+        else:
+            line_offset, line_start = self.offset + len(self.buffer), self.line_start
+        line_time = self.line_time or time.time()
+        command = None
+        if self.prompt is not None and line_start and line.startswith(self.prompt) and line.endswith(b'\n'):
+            command = line[len(self.prompt):].strip()
+        if self.timestamps and self.line_start:
+            if line_time - self.last_time_index >= LOG_TIME_INDEX_INTERVAL:
+                self.time_index.append(f'{int(line_time)} {line_offset} {self.lines + 1}\n')
+                self.last_time_index = line_time
+            second = int(line_time)
+            if second != self.prefix_second:
+                self.prefix_second = second
+                self.prefix = time.strftime('[%Y-%m-%d %H:%M:%S] ', time.localtime(second)).encode()
+            self.buffer += self.prefix
+        self.buffer += line[len(partial):]
+        if not complete:
+            self.partial, self.partial_offset, self.partial_line_start = line, line_offset, line_start
+        if command:
+            self.command_index.append({
+                'time': int(line_time),
+                'prompt': self.prompt.decode('UTF-8', errors='replace').strip(),
+                'command': command.decode('UTF-8', errors='replace'),
+                'start': line_offset,
+                'output': self.offset + len(self.buffer),
+            })
+        self.line_start = line.endswith(b'\n')
+        if self.line_start:
+            self.lines += 1
+            self.line_time = None
+
+    def time_to_flush(self):
+        """
+        Seconds until the next flush by time. None if there is nothing to flush.
+        """
+        if len(self.buffer) == 0 and not self.unwritten_line():
+            return None
+        return max(0, self.last_flush + self.flush_interval - time.monotonic())
+
+    def flush_if_due(self):
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush_by_time()
+        elif len(self.buffer) >= self.flush_size:
+            self.flush()
+
+    def flush_by_time(self):
+        """
+        Flush with incomplete last line, so prompt, that waits for input, is in the log.
+        """
+        if self.unwritten_line():
+            self.write_line(bytes(self.line), complete=False)
+        self.flush()
+
+    def unwritten_line(self):
+        return len(self.line) != 0 and self.line != self.partial
+
+    def flush(self):
+        if len(self.buffer) != 0:
+            self.file.write(self.buffer)
+            self.file.flush()
+            self.offset += len(self.buffer)
+            self.buffer.clear()
+        # Indexes are written after the log, so they never point past the end of the log.
+        if self.time_index:
+            self.time_index_file.write(''.join(self.time_index))
+            self.time_index_file.flush()
+            self.time_index.clear()
+        if self.command_index:
+            if self.command_index_file is None:
+                self.command_index_file = open(log_sidecar_filename(self.file.name, LOG_COMMAND_INDEX), 'a')
+            self.command_index_file.write(''.join(json.dumps(entry) + '\n' for entry in self.command_index))
+            self.command_index_file.flush()
+            self.command_index.clear()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        if len(self.line) != 0 or self.partial:
+            self.write_line(bytes(self.line or self.partial) + b'\n')
+            self.line.clear()
+        self.flush()
+        self.file.close()
+        for index_file in (self.time_index_file, self.command_index_file):
+            if index_file is not None:
+                index_file.close()
+
+
+def read_log_time_index(log_file):
+    """
+    Returns time index of the log: list of (unix_time, offset, line_number).
+    """
+    entries = []
+    index_file = log_sidecar_filename(log_file, LOG_TIME_INDEX)
+    if os.path.exists(index_file):
+        with open(index_file, 'r') as f:
+            for line in f:
+                entry = line.split()
+                if len(entry) == 3 and all(part.isdigit() for part in entry):
+                    entries.append(tuple(int(part) for part in entry))
+    return entries
+
+
+def count_log_lines(log_file, size):
+    """
+    Returns number of lines in the first size bytes of the log, that is appended again. Lines are counted
+    from the last time index entry, so the whole log is not read.
+    """
+    entries = read_log_time_index(log_file)
+    _, offset, line_number = entries[-1] if entries else (0, 0, 1)
+    with open(log_file, 'rb') as f:
+        f.seek(offset)
+        lines = line_number - 1
+        while f.tell() < size:
+            lines += f.read(min(LOG_SEARCH_CHUNK_SIZE, size - f.tell())).count(b'\n')
+    return lines
+
+
+def save_pane_history(output_file_name, pane_id=':', pipe=None, only_once=False):
+    """
+    Saves pane output to a file. Output streamed by pipe-pane is appended to the file as it comes.
+    With only_once, whole pane history is captured to a file once.
+    """
+    if only_once or pipe is None:
+        output = tmux('capture-pane', '-J', '-p', '-S', '-', '-t', pane_id)
+        with open(output_file_name, 'w') as f:
+            f.write(output)
+        return
+
+    settings = load_settings()
+    writer = PaneLogWriter(output_file_name, settings['log_flush_size'], settings['log_flush_interval'],
+                           settings['log_timestamps'])
+    # pipe-pane closes the pipe, when logging is toggled off, but tmux may also kill us on exit.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    signal.signal(signal.SIGHUP, lambda *_: sys.exit(0))
+    input_fd = pipe.fileno()
+    try:
+        while True:
+            ready, _, _ = select.select([input_fd], [], [], writer.time_to_flush())
+            if ready:
+                data = os.read(input_fd, writer.flush_size)
+                if not data:
+                    break
+                writer.feed(data)
+            else:
+                writer.flush_by_time()
+    finally:
+        writer.close()
+
+
+# {year}/{month}/{day}/{hour}_{minute}_{second}---!{session_index}_{connection_type}_{host}.log
+LOG_FILENAME_RE = re.compile(
+    r'^(\d{4})/(\d{2})/(\d{2})/(\d{2})_(\d{2})_(\d{2})---!([^_]*)_([a-z])_(.*)\.log(?:\.gz|\.zst)?$'
+)
+
+
+def log_index_connection():
+    """
+    Returns connection to the log index database. Index maps session index, host, connection type and
+    start time of the session to the log file path, relative to the log directory.
+    If database doesn't exist yet, it's built from log files that are already there.
+    """
+    create_dir(lPaths.log_index)
+    new_index = not os.path.exists(lPaths.log_index)
+    connection = sqlite3.connect(lPaths.log_index, timeout=10)
+    if new_index:
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS logs (
+                path TEXT PRIMARY KEY,
+                session_index INTEGER,
+                connection_type TEXT,
+                host TEXT,
+                started TEXT
+            );
+            CREATE INDEX IF NOT EXISTS logs_session_index ON logs (session_index);
+        """)
+        rebuild_log_index(connection)
+    return connection
+
+
+def parse_log_filename(path):
+    """
+    Returns (path, session_index, connection_type, host, started) for log file path relative to the log
+    directory, or None if it's not a log file name.
+    """
+    match = LOG_FILENAME_RE.match(path)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, session_index, connection_type, host = match.groups()
+    session_index = int(session_index) if session_index.isdigit() else None
+    started = f'{year}-{month}-{day} {hour}:{minute}:{second}'
+    return path, session_index, connection_type, host, started
+
+
+def add_log_to_index(log_filename):
+    """
+    Adds new log file to the log index.
+    """
+    add_logs_to_index([log_filename])
+
+
+def add_logs_to_index(log_filenames):
+    """
+    Adds new log files to the log index in one transaction.
+    """
+    log_entries = [parse_log_filename(os.path.relpath(log_filename, lPaths.log_dir))
+                   for log_filename in log_filenames]
+    log_entries = [log_entry for log_entry in log_entries if log_entry is not None]
+    if not log_entries:
+        return
+    with contextlib.closing(log_index_connection()) as connection, connection:
+        connection.executemany('INSERT OR REPLACE INTO logs VALUES (?, ?, ?, ?, ?)', log_entries)
+
+
+def rebuild_log_index(connection=None):
+    """
+    Builds log index from scratch, from the files in log directory.
+    """
+    if connection is None:
+        with contextlib.closing(log_index_connection()) as connection:
+            return rebuild_log_index(connection)
+
+    log_entries = []
+    if os.path.exists(lPaths.log_dir):
+        for directory, _, files in os.walk(lPaths.log_dir):
+            relative_directory = os.path.relpath(directory, lPaths.log_dir)
+            for file_name in files:
+                log_entry = parse_log_filename(f'{relative_directory}/{file_name}')
+                if log_entry is not None:
+                    log_entries.append(log_entry)
+    with connection:
+        connection.execute('DELETE FROM logs')
+        connection.executemany('INSERT OR REPLACE INTO logs VALUES (?, ?, ?, ?, ?)', log_entries)
+    return len(log_entries)
+
+
+def find_log_file(history_index):
+    """
+    Returns path of the log file for session index, or None if there is no such session in the index.
+    """
+    with contextlib.closing(log_index_connection()) as connection:
+        row = connection.execute(
+            'SELECT path FROM logs WHERE session_index = ? ORDER BY started DESC LIMIT 1',
+            (history_index,)
+        ).fetchone()
+    if row is None:
+        return None
+    return f'{lPaths.log_dir}/{row[0]}'
+
+
+def pane_log_filename(connection_type, host, session_index):
+    """
+    Returns name of the new log file.
+    """
+    now = datetime.datetime.now()
+    log_filename = (f'{lPaths.log_dir}/{now.strftime("%Y/%m/%d/%H_%M_%S")}'
+                    f'---!{session_index}_{connection_type}_{host}.log')
+    create_dir(log_filename)
+    return log_filename
+
+
+def pipe_pane_command(log_filename, target=(), toggle=True):
+    """
+    Returns tmux command, that starts writing pane output to the log file. With toggle it stops the log,
+    if pane is already logged, otherwise the old log of the pane is replaced.
+    """
+    return [
+        'pipe-pane',
+        *(['-o'] if toggle else []),
+        *target,
+        f'{lPaths.script} save_pane_history --file_name "{log_filename}" --pane_id #{{pane_id}} -i -'
+    ]
+
+
+def pane_log(connection_type, host, pane_id=None):
+    """
+    Toggle log of the pane, that is not a connection. Current pane is used, if pane_id is not given.
+    Log file is kept in @noc_log pane option, so snapshot can find it.
+    """
+    target = [] if pane_id is None else ['-t', pane_id]
+    # Log is toggled, if pane is already logged, new log file will not be created.
+    new_log = tmux('display-message', '-p', *target, '#{pane_pipe}').strip() != '1'
+    log_filename = pane_log_filename(connection_type, host, '--')
+    if new_log:
+        add_log_to_index(log_filename)
+    tmux_batch([['set', '-p', *target, '@noc_log', log_filename], pipe_pane_command(log_filename, target)])
+
+
+def connection_log_commands(connection_type, host, session_index, target):
+    """
+    Returns tmux commands, that name connection pane and start it's log. Log is added to the log index.
+    """
+    short_type = CONNECTION_TYPES[connection_type]
+    log_filename = pane_log_filename(short_type, host, session_index)
+    add_log_to_index(log_filename)
+    return [
+        ['set', '-p', *target, '@pane_name', f'{short_type}/{host}'],
+        ['set', '-p', *target, '@noc_log', log_filename],
+        pipe_pane_command(log_filename, target, toggle=False),
+    ]
+
+
+# Log files, that were not changed for this many seconds, are not checked for new lines anymore.
+LOG_SEARCH_FINAL_AGE = 24 * 60 * 60
+LOG_SEARCH_CHUNK_SIZE = 4 * 1024 * 1024
+# Line rowid is file_id << 32 | line number, so lines of one file can be found by rowid range.
+LINE_ROWID_SHIFT = 32
+CONNECTION_TYPES = {'ssh': 's', 'telnet': 't', 'local': 'l'}
+
+
+def log_search_connection():
+    """
+    Returns connection to full-text search index of logs, or None if SQLite is built without FTS5.
+    Every log line is a row in "lines", "files" keeps how much of each log file is already indexed.
+    """
+    create_dir(lPaths.log_search)
+    connection = sqlite3.connect(lPaths.log_search, timeout=10)
+    try:
+        connection.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE,
+                session_index INTEGER,
+                connection_type TEXT,
+                host TEXT,
+                started TEXT,
+                indexed_size INTEGER DEFAULT 0,
+                indexed_lines INTEGER DEFAULT 0,
+                final INTEGER DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS files_started ON files (started);
+            CREATE VIRTUAL TABLE IF NOT EXISTS lines USING fts5(text, file_id UNINDEXED, line UNINDEXED);
+        """)
+    except sqlite3.OperationalError:
+        connection.close()
+        return None
+    return connection
+
+
+def index_logs(connection, progress=False):
+    """
+    Adds new log files and new lines of growing log files to the search index.
+    Only complete lines are indexed, the rest will be indexed next time.
+    """
+    with contextlib.closing(log_index_connection()) as index_connection:
+        known_paths = {row[0] for row in connection.execute('SELECT path FROM files')}
+        new_files = [row for row in index_connection.execute('SELECT * FROM logs') if row[0] not in known_paths]
+    with connection:
+        connection.executemany(
+            'INSERT INTO files (path, session_index, connection_type, host, started) VALUES (?, ?, ?, ?, ?)',
+            new_files
+        )
+    pending_files = connection.execute(
+        'SELECT id, path, indexed_size, indexed_lines FROM files WHERE final = 0'
+    ).fetchall()
+    if progress and new_files:
+        print(f'{ANSIColors.OKBLUE}Indexing {len(new_files)} new log files...{ANSIColors.ENDC}')
+
+    now = time.time()
+    for file_id, path, indexed_size, indexed_lines in pending_files:
+        full_path = f'{lPaths.log_dir}/{path}'
+        try:
+            stat = os.stat(full_path)
+        except FileNotFoundError:
+            with connection:
+                connection.execute('UPDATE files SET final = 1 WHERE id = ?', (file_id,))
+            continue
+        if path.endswith(('.gz', '.zst')):
+            # Compressed log doesn't change anymore, lines that are not indexed yet are added.
+            with open_log_lines(full_path) as lines, connection:
+                new_lines = []
+                for line_number, line in enumerate(lines, 1):
+                    if line_number > indexed_lines and line.strip():
+                        new_lines.append(((file_id << LINE_ROWID_SHIFT) + line_number,
+                                          line.rstrip(b'\n').decode('UTF-8', errors='replace'), file_id, line_number))
+                connection.executemany('INSERT INTO lines (rowid, text, file_id, line) VALUES (?, ?, ?, ?)', new_lines)
+                connection.execute('UPDATE files SET final = 1 WHERE id = ?', (file_id,))
+            continue
+        if stat.st_size < indexed_size:
+            # File was rewritten, index it again.
+            with connection:
+                delete_file_lines(connection, file_id)
+            indexed_size, indexed_lines = 0, 0
+        with open(full_path, 'rb') as f, connection:
+            f.seek(indexed_size)
+            data = b''
+            for chunk in iter(lambda: f.read(LOG_SEARCH_CHUNK_SIZE), b''):
+                data += chunk
+                complete_data = data[:data.rfind(b'\n') + 1]
+                data = data[len(complete_data):]
+                indexed_size += len(complete_data)
+                new_lines = []
+                for line in complete_data.decode('UTF-8', errors='replace').split('\n')[:-1]:
+                    indexed_lines += 1
+                    if line.strip():
+                        new_lines.append(((file_id << LINE_ROWID_SHIFT) + indexed_lines, line, file_id, indexed_lines))
+                connection.executemany('INSERT INTO lines (rowid, text, file_id, line) VALUES (?, ?, ?, ?)', new_lines)
+            final = int(now - stat.st_mtime > LOG_SEARCH_FINAL_AGE)
+            connection.execute(
+                'UPDATE files SET indexed_size = ?, indexed_lines = ?, final = ? WHERE id = ?',
+                (indexed_size, indexed_lines, final, file_id)
+            )
+
+
+def delete_file_lines(connection, file_id):
+    """
+    Removes all lines of the log file from the search index.
+    """
+    connection.execute(
+        'DELETE FROM lines WHERE rowid >= ? AND rowid < ?',
+        (file_id << LINE_ROWID_SHIFT, (file_id + 1) << LINE_ROWID_SHIFT)
+    )
+
+
+def logged_files():
+    """
+    Returns set of log files, that pane loggers are writing to right now. Loggers are found by their
+    command line in /proc.
+    """
+    open_files = set()
+    if not os.path.exists('/proc'):
+        return open_files
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                cmdline = f.read().split(b'\0')
+        except OSError:
+            continue
+        if b'save_pane_history' in cmdline and b'--file_name' in cmdline[:-1]:
+            file_name = cmdline[cmdline.index(b'--file_name') + 1].decode('UTF-8', errors='replace')
+            open_files.add(os.path.realpath(file_name))
+    return open_files
+
+
+def move_log_in_indexes(path, new_path):
+    """
+    Changes log file path in log index and search index. new_path None removes the log from indexes.
+    Paths are relative to the log directory.
+    """
+    with contextlib.closing(log_index_connection()) as connection, connection:
+        if new_path is None:
+            connection.execute('DELETE FROM logs WHERE path = ?', (path,))
+        else:
+            connection.execute('UPDATE logs SET path = ? WHERE path = ?', (new_path, path))
+    search_connection = log_search_connection()
+    if search_connection is None:
+        return
+    with contextlib.closing(search_connection) as connection, connection:
+        if new_path is None:
+            row = connection.execute('SELECT id FROM files WHERE path = ?', (path,)).fetchone()
+            if row is not None:
+                delete_file_lines(connection, row[0])
+                connection.execute('DELETE FROM files WHERE id = ?', (row[0],))
+        else:
+            connection.execute('UPDATE files SET path = ? WHERE path = ?', (new_path, path))
+
+
+def compress_log_file(path, compression):
+    """
+    Compresses log file (relative to the log directory) with zstd or gzip and replaces it with compressed
+    one. Indexes are updated before the original file is removed, so log is always found.
+    """
+    full_path = f'{lPaths.log_dir}/{path}'
+    extension = '.zst' if compression == 'zstd' else '.gz'
+    temporary_path = f'{full_path}{extension}.tmp'
+    if compression == 'zstd':
+        subprocess.run(['zstd', '-q', '-f', '-o', temporary_path, full_path], check=True)
     else:
-        return ['tmux', 'new-window']
+        with open(full_path, 'rb') as source, gzip.open(temporary_path, 'wb') as destination:
+            shutil.copyfileobj(source, destination)
+    shutil.copystat(full_path, temporary_path)
+    os.rename(temporary_path, full_path + extension)
+    move_log_in_indexes(path, path + extension)
+    os.remove(full_path)
+
+
+def compact_logs():
+    """
+    Compresses logs in day directories before today, that are not written anymore, and deletes logs by
+    log_retention_days and log_max_size_mb settings. Returns (compressed, deleted) files count.
+    """
+    settings = load_settings()
+    compression = settings['log_compression']
+    if compression == 'zstd' and shutil.which('zstd') is None:
+        compression = 'gzip'
+    today = datetime.date.today()
+    open_files = logged_files()
+    compressed, deleted = 0, 0
+
+    logs = []
+    for partition in log_partitions():
+        partition_date = datetime.date(*(int(part) for part in partition.split('/')))
+        for file_name in sorted(os.listdir(f'{lPaths.log_dir}/{partition}')):
+            path = f'{partition}/{file_name}'
+            if parse_log_filename(path) is None:
+                continue
+            full_path = f'{lPaths.log_dir}/{path}'
+            if os.path.realpath(full_path) in open_files:
+                continue
+            if partition_date < today and file_name.endswith('.log'):
+                compress_log_file(path, compression)
+                path = path + ('.zst' if compression == 'zstd' else '.gz')
+                compressed += 1
+            logs.append((partition_date, path, os.path.getsize(f'{lPaths.log_dir}/{path}')))
+
+    retention_days = settings['log_retention_days']
+    max_size = settings['log_max_size_mb'] * 1024 * 1024
+    total_size = sum(size for _, _, size in logs)
+    for partition_date, path, size in logs:
+        expired = retention_days and (today - partition_date).days > retention_days
+        if not expired and (not max_size or total_size <= max_size):
+            break
+        move_log_in_indexes(path, None)
+        os.remove(f'{lPaths.log_dir}/{path}')
+        for extension in (LOG_TIME_INDEX, LOG_COMMAND_INDEX):
+            if os.path.exists(log_sidecar_filename(f'{lPaths.log_dir}/{path}', extension)):
+                os.remove(log_sidecar_filename(f'{lPaths.log_dir}/{path}', extension))
+        total_size -= size
+        deleted += 1
+
+    # Remove empty day, month and year directories. Today's directories are kept, new log may be about to be
+    # opened in them: pane_log_filename creates directory before the log is written.
+    today_path = today.strftime('%Y/%m/%d').split('/')
+    kept = {f'{lPaths.log_dir}/{"/".join(today_path[:length])}' for length in range(1, 4)}
+    for directory, _, _ in sorted(os.walk(lPaths.log_dir), reverse=True):
+        if directory != lPaths.log_dir and directory not in kept and not os.listdir(directory):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # Log was just created in it.
+                pass
+    return compressed, deleted
+
+
+def parse_search_query(query):
+    """
+    Splits query to full-text search words and filters: host:name, type:ssh|telnet|local,
+    from:YYYY-MM-DD and to:YYYY-MM-DD. Everything after "re:" is a regular expression.
+    Returns (words, filters, regex).
+    """
+    words, filters, regex = [], {}, None
+    regex_match = re.search(r'(?:^|\s)re:(.*)$', query)
+    if regex_match is not None:
+        query, regex = query[:regex_match.start()], regex_match.group(1)
+    for word in query.split():
+        name, _, value = word.partition(':')
+        if name in ('host', 'type', 'from', 'to') and value:
+            filters[name] = CONNECTION_TYPES.get(value, value) if name == 'type' else value
+        else:
+            words.append(word)
+    return words, filters, regex
+
+
+def search_log_index(connection, words, filters, limit):
+    """
+    Returns [(path, line_number, line)] for lines with all the words, best matches first.
+    """
+    # Every word is a phrase, so words with punctuation, like IP addresses, are found as is.
+    match = ' AND '.join(
+        '"' + word[:-1].replace('"', '""') + '"*' if word.endswith('*') else '"' + word.replace('"', '""') + '"'
+        for word in words
+    )
+    conditions, parameters = ['lines MATCH ?'], [match]
+    if 'host' in filters:
+        conditions.append('files.host LIKE ?')
+        parameters.append(f'%{filters["host"]}%')
+    if 'type' in filters:
+        conditions.append('files.connection_type = ?')
+        parameters.append(filters['type'])
+    if 'from' in filters:
+        conditions.append('files.started >= ?')
+        parameters.append(filters['from'])
+    if 'to' in filters:
+        conditions.append('files.started < ?')
+        parameters.append(filters['to'] + '~')
+    parameters.append(limit)
+    return connection.execute(
+        'SELECT files.path, lines.line, lines.text FROM lines JOIN files ON files.id = lines.file_id '
+        f'WHERE {" AND ".join(conditions)} ORDER BY rank LIMIT ?',
+        parameters
+    ).fetchall()
+
+
+def print_search_result(path, line_number, line):
+    """
+    Prints search result like grep --color=always does.
+    """
+    print(f'\033[35m./{path}\033[m\033[36m:\033[m\033[32m{line_number}\033[m\033[36m:\033[m{line}')
+
+
+def log_partitions(date_from=None, date_to=None):
+    """
+    Returns day directories of logs ("YYYY/MM/DD"), that are in date range, oldest first.
+    Dates are "YYYY-MM-DD" strings, directories out of range are not listed deeper.
+    """
+    def sorted_subdirectories(directory):
+        try:
+            return sorted(entry.name for entry in os.scandir(directory) if entry.is_dir())
+        except FileNotFoundError:
+            return []
+
+    partitions = []
+    for year in sorted_subdirectories(lPaths.log_dir):
+        if (date_from and year < date_from[:4]) or (date_to and year > date_to[:4]):
+            continue
+        for month in sorted_subdirectories(f'{lPaths.log_dir}/{year}'):
+            if (date_from and f'{year}-{month}' < date_from[:7]) or (date_to and f'{year}-{month}' > date_to[:7]):
+                continue
+            for day in sorted_subdirectories(f'{lPaths.log_dir}/{year}/{month}'):
+                date = f'{year}-{month}-{day}'
+                if (date_from and date < date_from[:10]) or (date_to and date > date_to[:10]):
+                    continue
+                partitions.append(f'{year}/{month}/{day}')
+    return partitions
+
+
+@contextlib.contextmanager
+def open_log_lines(path):
+    """
+    Yields binary file of the log, that can be iterated over lines. Compressed .gz and .zst files are
+    decompressed. zstd process is waited for at the end, so it's not left as zombie.
+    """
+    if path.endswith('.zst'):
+        process = subprocess.Popen(['zstd', '-dcq', path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            yield process.stdout
+        finally:
+            # zstd, that is not done yet, gets SIGPIPE.
+            process.stdout.close()
+            process.wait()
+        return
+    with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')) as f:
+        yield f
+
+
+def grep_log_partition(partition, pattern, filters, limit):
+    """
+    Returns formatted grep results for log files in one day directory, not more than limit. Runs in process pool.
+    """
+    regex = re.compile(pattern.encode('UTF-8'))
+    results = []
+    for file_name in sorted(os.listdir(f'{lPaths.log_dir}/{partition}')):
+        log_entry = parse_log_filename(f'{partition}/{file_name}')
+        if log_entry is None:
+            continue
+        _, _, connection_type, host, _ = log_entry
+        if 'host' in filters and filters['host'] not in host:
+            continue
+        if 'type' in filters and filters['type'] != connection_type:
+            continue
+        if file_name.endswith('.zst') and shutil.which('zstd') is None:
+            results.append(f'{ANSIColors.FAIL}zstd is not installed, {partition}/{file_name} '
+                           f'is not searched.{ANSIColors.ENDC}')
+            continue
+        with open_log_lines(f'{lPaths.log_dir}/{partition}/{file_name}') as lines:
+            for line_number, line in enumerate(lines, 1):
+                if regex.search(line) is None:
+                    continue
+                line = regex.sub(lambda match: b'\033[01;31m\033[K' + match.group(0) + b'\033[m\033[K', line)
+                line = line.rstrip(b'\n').decode('UTF-8', errors='replace')
+                results.append(
+                    f'\033[35m./{partition}/{file_name}\033[m\033[36m:\033[m\033[32m{line_number}\033[m'
+                    f'\033[36m:\033[m{line}'
+                )
+                if len(results) >= limit:
+                    return results
+    return results
+
+
+def grep_logs(pattern, filters, limit, executor=None):
+    """
+    Searches regular expression in logs with process pool, one task per day directory. Day directories
+    out of from/to filters are not read. Yields results in the order of dates, as soon as they are ready,
+    not more than limit. Only as many days, as there are CPUs, are searched ahead, and every day stops
+    at limit results, so memory doesn't grow with the size of logs.
+    """
+    partitions = iter(log_partitions(filters.get('from'), filters.get('to')))
+    if executor is None:
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            yield from grep_logs(pattern, filters, limit, executor)
+        return
+    pending = collections.deque(
+        executor.submit(grep_log_partition, partition, pattern, filters, limit)
+        for partition in itertools.islice(partitions, os.cpu_count() or 1)
+    )
+    found = 0
+    try:
+        while pending:
+            partition_results = pending.popleft().result()
+            partition = next(partitions, None)
+            if partition is not None:
+                pending.append(executor.submit(grep_log_partition, partition, pattern, filters, limit))
+            for result in partition_results[:limit - found]:
+                yield result
+            found += len(partition_results)
+            if found >= limit:
+                return
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def search_logs():
+    """
+    Search in logs. Log lines are indexed before every query, only new lines are read.
+    Regular expressions and queries without FTS5 support in SQLite are searched with grep_logs.
+    """
+    rename_window()
+    connection = log_search_connection()
+    limit = load_settings()['search_limit']
+    print(f'{ANSIColors.OKBLUE}Filters: host:name type:ssh|telnet|local from:YYYY-MM-DD to:YYYY-MM-DD. '
+          f'Word ending with * is a prefix. Everything after re: is a regular expression.{ANSIColors.ENDC}')
+    executor = concurrent.futures.ProcessPoolExecutor()
+    while True:
+        try:
+            query = input(f'{ANSIColors.WARNING}search in logs:{ANSIColors.ENDC} ')
+        except (EOFError, KeyboardInterrupt):
+            print()
+            break
+        words, filters, regex = parse_search_query(query)
+        if not words and not regex:
+            print(f'{ANSIColors.FAIL}Empty query.{ANSIColors.ENDC}')
+            continue
+        if regex is not None or connection is None:
+            if regex is None:
+                regex = re.escape(' '.join(words))
+            try:
+                re.compile(regex)
+            except re.error as exc:
+                print(f'{ANSIColors.FAIL}Wrong regular expression: {exc}.{ANSIColors.ENDC}')
+                continue
+            found = 0
+            for result in grep_logs(regex, filters, limit, executor):
+                print(result)
+                found += 1
+            if found == limit:
+                print(f'{ANSIColors.WARNING}Only first {limit} results are shown.{ANSIColors.ENDC}')
+            elif not found:
+                print(f'{ANSIColors.FAIL}Nothing found.{ANSIColors.ENDC}')
+            continue
+        index_logs(connection, progress=True)
+        results = search_log_index(connection, words, filters, limit)
+        for path, line_number, line in results:
+            print_search_result(path, line_number, line)
+        if len(results) == limit:
+            print(f'{ANSIColors.WARNING}Only first {limit} results are shown.{ANSIColors.ENDC}')
+        elif not results:
+            print(f'{ANSIColors.FAIL}Nothing found.{ANSIColors.ENDC}')
+
+
+def tmux_dm(message):
+    """
+    Display message in status line.
+    """
+    tmux('display-message', message)
+
+
+def tmux_set_pane_name(name, pane_id=None):
+    """
+    Setting pane name.
+    """
+    if pane_id is None:
+        tmux('set', '-p', '@pane_name', name)
+    else:
+        tmux('set', '-p', '-t', pane_id, '@pane_name', name)
+
+
+def log_sidecar_filename(log_file, extension):
+    """
+    Returns file name of the log's time or command index. Compressed log uses indexes of the original log:
+    offsets are offsets in uncompressed log.
+    """
+    return re.sub(r'\.(gz|zst)$', '', log_file) + extension
+
+
+def parse_log_time(at, started):
+    """
+    Returns unix time of HH:MM[:SS] time during the session started at "YYYY-MM-DD HH:MM:SS".
+    Time before the session start is the next day. None if time is not valid.
+    """
+    match = re.match(r'^(\d{1,2}):(\d{2})(?::(\d{2}))?$', at)
+    if match is None:
+        return None
+    hour, minute, second = (int(part or 0) for part in match.groups())
+    if hour > 23 or minute > 59 or second > 59:
+        return None
+    started = datetime.datetime.strptime(started, '%Y-%m-%d %H:%M:%S')
+    at_time = started.replace(hour=hour, minute=minute, second=second)
+    if at_time < started:
+        at_time += datetime.timedelta(days=1)
+    return time.mktime(at_time.timetuple())
+
+
+def log_position_at(log_file, at_time):
+    """
+    Returns (byte_offset, line_number) of the first line at or after unix time at_time in timestamped log,
+    using its time index. Only the part of plain log after the index entry is read. Compressed log can't
+    be read from the middle, so position of the index entry is returned for it. None if log has no time index.
+    """
+    entries = read_log_time_index(log_file)
+    if not entries:
+        return None
+    position = (0, 1)
+    for entry_time, offset, line_number in entries:
+        if entry_time > at_time:
+            break
+        position = (offset, line_number)
+    if log_file.endswith(('.gz', '.zst')):
+        return position
+    offset, line_number = position
+    with open(log_file, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            match = LOG_TIMESTAMP_RE.match(line)
+            if match is not None:
+                line_time = time.mktime(time.strptime(match.group(1).decode(), '%Y-%m-%d %H:%M:%S'))
+                if line_time >= at_time:
+                    break
+            offset += len(line)
+            line_number += 1
+    return offset, line_number
+
+
+def open_log(history_index, split_direction, at=None):
+    """
+    Open log file in less. Log index can be followed by HH:MM[:SS] time, to open timestamped log at this time.
+    """
+    if history_index is not None and at is None and len(history_index.split()) == 2:
+        history_index, at = history_index.split()
+    if history_index is None or not history_index.strip().isdigit():
+        tmux_dm(f'Log index should be a number, not "{history_index}".')
+        return
+    log_file = find_log_file(int(history_index))
+    if log_file is None or not os.path.exists(log_file):
+        tmux_dm(f'Log file with index {history_index} not found.')
+    else:
+        log_file_short = log_file.replace(lPaths.log_dir + '/', '')
+        less_arguments = '-m'
+        if at:
+            log_entry = parse_log_filename(log_file_short)
+            at_time = parse_log_time(at, log_entry[4]) if log_entry is not None else None
+            position = log_position_at(log_file, at_time) if at_time is not None else None
+            if at_time is None:
+                tmux_dm(f'Time should be HH:MM or HH:MM:SS, not "{at}".')
+                return
+            if position is None:
+                tmux_dm(f'Log {history_index} has no timestamps, it is opened from the start.')
+            elif log_file.endswith(('.gz', '.zst')):
+                # less can't go to byte offset in a pipe, but it can go to line.
+                less_arguments += f' +{position[1]}g'
+            else:
+                less_arguments += f' +{position[0]}P'
+        if log_file.endswith('.zst'):
+            less_command = f'zstd -dcq "{log_file}" | less {less_arguments}'
+        elif log_file.endswith('.gz'):
+            less_command = f'gzip -dc "{log_file}" | less {less_arguments}'
+        else:
+            less_command = f'less {less_arguments} "{log_file}"'
+        tmux(*get_split_command(split_direction), less_command)
+        tmux_set_pane_name(f'Log:{log_file_short}')
+        rename_window()
+
+
+def read_log_commands(log_file):
+    """
+    Returns commands from the command index of the log, with "end" offset of the output added: start of
+    the next command, or None for the last command, it's output goes to the end of the log.
+    """
+    commands = []
+    index_file = log_sidecar_filename(log_file, LOG_COMMAND_INDEX)
+    if os.path.exists(index_file):
+        with open(index_file, 'r') as f:
+            for line in f:
+                try:
+                    commands.append(json.loads(line))
+                except ValueError:
+                    continue
+    for command, next_command in zip(commands, commands[1:] + [None]):
+        command['end'] = next_command['start'] if next_command is not None else None
+    return commands
+
+
+def read_log_range(log_file, start, end):
+    """
+    Returns bytes from start to end (None for the end of file) offsets of uncompressed log. Plain and gzip
+    logs are read from start offset, zstd log is decompressed and skipped to it.
+    """
+    size = None if end is None else end - start
+    if log_file.endswith('.zst'):
+        with open_log_lines(log_file) as f:
+            while start > 0:
+                skipped = len(f.read(min(start, LOG_SEARCH_CHUNK_SIZE)))
+                if skipped == 0:
+                    return b''
+                start -= skipped
+            return f.read() if size is None else f.read(size)
+    opener = gzip.open if log_file.endswith('.gz') else open
+    with opener(log_file, 'rb') as f:
+        f.seek(start)
+        return f.read() if size is None else f.read(size)
+
+
+def strip_prompt_lines(output, prompt):
+    """
+    Removes lines with the prompt and without command from the end of the command output.
+    """
+    lines = output.splitlines(keepends=True)
+    while lines and LOG_TIMESTAMP_RE.sub(b'', lines[-1]).strip() == prompt.encode('UTF-8', errors='replace'):
+        lines.pop()
+    return b''.join(lines)
+
+
+def log_commands(history_index, command_number=None):
+    """
+    Lists commands of the session log and shows output of the chosen command in less. Only output of this
+    command is read from the log. With command_number, prints output of this command and exits.
+    """
+    rename_window()
+    if history_index is None or not history_index.strip().isdigit():
+        print(f'{ANSIColors.FAIL}Log index should be a number, not "{history_index}".{ANSIColors.ENDC}')
+        return
+    log_file = find_log_file(int(history_index))
+    if log_file is None or not os.path.exists(log_file):
+        print(f'{ANSIColors.FAIL}Log file with index {history_index} not found.{ANSIColors.ENDC}')
+        return
+    commands = read_log_commands(log_file)
+    if command_number is not None:
+        if not command_number.isdigit() or not 0 < int(command_number) <= len(commands):
+            print(f'{ANSIColors.FAIL}There is no command {command_number} in log {history_index}.{ANSIColors.ENDC}')
+            return
+        command = commands[int(command_number) - 1]
+        sys.stdout.flush()
+        output = read_log_range(log_file, command['output'], command['end'])
+        sys.stdout.buffer.write(strip_prompt_lines(output, command['prompt']))
+        return
+    if not commands:
+        print(f'{ANSIColors.FAIL}No commands found in log {history_index}.{ANSIColors.ENDC}')
+        return
+    while True:
+        for number, command in enumerate(commands, 1):
+            output_size = '' if command['end'] is None else f'{command["end"] - command["output"]} bytes'
+            started = time.strftime('%H:%M:%S', time.localtime(command['time']))
+            print(f'{ANSIColors.OKBLUE}{number:>5}{ANSIColors.ENDC} {started} '
+                  f'{command["prompt"]} {ANSIColors.WARNING}{command["command"]}{ANSIColors.ENDC} {output_size}')
+        try:
+            number = input(f'{ANSIColors.WARNING}command number:{ANSIColors.ENDC} ').strip()
+        except (EOFError, KeyboardInterrupt):
+            print()
+            break
+        if not number.isdigit() or not 0 < int(number) <= len(commands):
+            continue
+        command = commands[int(number) - 1]
+        output = read_log_range(log_file, command['start'], command['end'])
+        subprocess.run(['less', '-m'], input=strip_prompt_lines(output, command['prompt']))
+
+
+def load_sessions_metadata():
+    if not os.path.exists(lPaths.sessions_metadata):
+        return {}
+    # Callers modify metadata before saving it, cached copy must stay untouched.
+    return copy.deepcopy(read_cached(lPaths.sessions_metadata, json.load))
+
+
+def recent_sessions_migrate(sessions_metadata, now):
+    """
+    Converts last_five_sessions list, that was used before recent sessions, to recent sessions.
+    """
+    recent = {}
+    for index, session in enumerate(sessions_metadata.pop('last_five_sessions', [])):
+        recent[f'{session["connection_type"]} {session["host"]}'] = [1, now - index, 1.0]
+    return recent
+
+
+def recent_session_rank(entry, half_life):
+    """
+    Returns frecency rank of recent session entry [count, last_time, weight]. Weight is decayed to the
+    last_time, so weights from different times are compared in log scale: log2(weight) + last_time / half_life.
+    """
+    return math.log2(entry[2]) + entry[1] / half_life
+
+
+def update_recent_sessions(sessions_metadata, connection_type, host, now, settings):
+    """
+    Adds session to recent sessions. Recent sessions are stored as dict with 'connection_type host' keys and
+    [count, last_time, weight] values, weight is decayed by half life and increased by 1 for every session.
+    """
+    half_life = settings['recent_sessions_half_life_days'] * 24 * 60 * 60
+    if 'recent_sessions' not in sessions_metadata:
+        sessions_metadata['recent_sessions'] = recent_sessions_migrate(sessions_metadata, now)
+    recent = sessions_metadata['recent_sessions']
+    key = f'{connection_type} {host}'
+    count, last_time, weight = recent.pop(key, [0, now, 0.0])
+    weight = weight * 0.5 ** (max(now - last_time, 0) / half_life) + 1
+    recent[key] = [count + 1, now, weight]
+
+    keep = settings['recent_sessions_keep']
+    if len(recent) > keep:
+        for stale_key in heapq.nsmallest(len(recent) - keep, recent,
+                                         key=lambda key: recent_session_rank(recent[key], half_life)):
+            del recent[stale_key]
+
+
+def recent_sessions(sessions_metadata, settings):
+    """
+    Returns list of (connection_type, host) of the most frecent sessions, the best first.
+    """
+    half_life = settings['recent_sessions_half_life_days'] * 24 * 60 * 60
+    if 'recent_sessions' in sessions_metadata:
+        recent = sessions_metadata['recent_sessions']
+    else:
+        recent = recent_sessions_migrate(dict(sessions_metadata), time.time())
+    best = heapq.nlargest(settings['recent_sessions_menu'], recent,
+                          key=lambda key: recent_session_rank(recent[key], half_life))
+    return [tuple(key.split(' ', 1)) for key in best]
+
+
+@contextlib.contextmanager
+def sessions_lock():
+    """
+    Exclusive lock for sessions metadata and journal. Sessions opened at the same time wait for each other,
+    so every session gets it's own index.
+    """
+    create_dir(lPaths.sessions_lock)
+    with open(lPaths.sessions_lock, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_file_atomic(filename, content, fsync=True):
+    """
+    Writes file content to the temporary file and replaces the file with it, so nobody reads half written file.
+    Files, that can be generated again, don't need fsync.
+    """
+    create_dir(filename)
+    temporary_filename = f'{filename}.{os.getpid()}.tmp'
+    with open(temporary_filename, 'w') as f:
+        f.write(content)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(temporary_filename, filename)
+
+
+def migrate_sessions_history():
+    """
+    Converts sessions_history.log, that was written before sessions journal, to the journal.
+    Should be called under sessions_lock.
+    """
+    entries = []
+    if os.path.exists(lPaths.sessions_history):
+        with open(lPaths.sessions_history, 'r') as f:
+            for line in f:
+                if not line.startswith('    '):
+                    continue
+                fields = line.strip('\n')[4:].split(' ', 4)
+                if len(fields) != 5 or not fields[0].isdigit():
+                    continue
+                index, date, session_time, connection_type, host = fields
+                day, month, year = date.split('.')
+                entries.append({
+                    'index': int(index),
+                    'started': f'{year}-{month}-{day} {session_time}',
+                    'connection_type': connection_type,
+                    'host': host,
+                })
+    append_sessions_journal(entries)
+
+
+def append_sessions_journal(entries):
+    """
+    Appends sessions to the journal. Journal is json lines file, that only grows.
+    """
+    create_dir(lPaths.sessions_journal)
+    with open(lPaths.sessions_journal, 'a') as f:
+        f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+
+
+def read_sessions_journal():
+    """
+    Yields sessions from the journal, oldest first.
+    """
+    if not os.path.exists(lPaths.sessions_journal):
+        return
+    with trace_span('read', 'sessions_journal.log'), open(lPaths.sessions_journal, 'r') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def sessions_history():
+    """
+    Prints sessions history, made from the journal, in human readable form.
+    """
+    last_date = None
+    for entry in read_sessions_journal():
+        date, session_time = entry['started'].split(' ')
+        year, month, day = date.split('-')
+        date = f'{day}.{month}.{year}'
+        if date != last_date:
+            print(f'# {date}')
+            last_date = date
+        print(f'    {entry["index"]} {date} {session_time} {entry["connection_type"]} {entry["host"]}')
+
+
+def save_session(connection_type, host):
+    """
+    Saves information about session and updates metadata. Returns session index.
+    """
+    return save_sessions([(connection_type, host)])[0]
+
+
+def save_sessions(sessions):
+    """
+    Saves information about sessions [(connection_type, host)] and updates metadata. Returns list of
+    session indexes. Metadata is replaced atomically and sessions are appended to the journal, both
+    once for all sessions under sessions lock.
+    """
+    settings = load_settings()
+    with sessions_lock():
+        if not os.path.exists(lPaths.sessions_journal):
+            migrate_sessions_history()
+        sessions_metadata = load_sessions_metadata()
+        started = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        session_index = sessions_metadata.get('last_session_index', 0)
+        journal_entries = []
+        for connection_type, host in sessions:
+            session_index += 1
+            update_recent_sessions(sessions_metadata, connection_type, host, time.time(), settings)
+            sessions_metadata[f'last_{connection_type}_session'] = host
+            journal_entries.append({
+                'index': session_index,
+                'started': started,
+                'connection_type': connection_type,
+                'host': host,
+            })
+        sessions_metadata['last_session_index'] = session_index
+        write_file_atomic(lPaths.sessions_metadata, json.dumps(sessions_metadata))
+        append_sessions_journal(journal_entries)
+    if not menus_state['daemon']:
+        invalidate_menus()
+    return [entry['index'] for entry in journal_entries]
+
+
+# Options of ssh config hosts, that are used by tmuxNOC.
+SSH_CONFIG_OPTIONS = {'hostname', 'port', 'user'}
+# ssh itself stops following Include after this depth.
+SSH_CONFIG_INCLUDE_DEPTH = 16
+# Parsed ssh config and stat of every file and include directory it was read from.
+ssh_config_cache = {}
+
+
+def ssh_config_stat(path):
+    """
+    Returns (mtime, size, inode) of file or directory, None if it doesn't exists.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def parse_ssh_config_line(line):
+    """
+    Returns (keyword, arguments) of ssh config line, keyword is lowercase. Returns None for empty lines
+    and comments. Keyword and arguments can be separated with spaces or "=", arguments can be quoted.
+    """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    match = re.match(r'(\S+?)\s*(?:=|\s)\s*(.*)$', line)
+    if match is None:
+        return line.lower(), []
+    keyword, arguments = match.groups()
+    try:
+        arguments = shlex.split(arguments, comments=True)
+    except ValueError:
+        arguments = arguments.split()
+    return keyword.lower(), arguments
+
+
+def read_ssh_config_file(path, blocks, stats, depth=0, conditions=()):
+    """
+    Appends Host blocks of ssh config file to blocks list: [patterns, options, conditions]. Include is followed
+    in place, like ssh does, so included options belong to the current Host block, and Host blocks of
+    included files don't change it: next included file and lines after Include belong to the same Host
+    block again. Host blocks of
+    file, that is included inside Host block, apply only to hosts, that match it too: conditions are
+    patterns of all such enclosing blocks. Lines before the first Host belong to block with "*" pattern.
+    Match blocks are skipped.
+    """
+    stats[path] = ssh_config_stat(path)
+    try:
+        with open(path, 'r', errors='replace') as f:
+            lines = f.readlines()
+    except OSError:
+        return
+    for line in lines:
+        parsed = parse_ssh_config_line(line)
+        if parsed is None:
+            continue
+        keyword, arguments = parsed
+        if keyword == 'host':
+            blocks.append([arguments, {}, conditions])
+        elif keyword == 'match':
+            blocks.append([[], {}, conditions])
+        elif keyword == 'include':
+            if depth >= SSH_CONFIG_INCLUDE_DEPTH:
+                continue
+            patterns, _, block_conditions = blocks[-1]
+            include_conditions = block_conditions if patterns == ['*'] else block_conditions + (patterns,)
+            for pattern in arguments:
+                pattern = os.path.expanduser(pattern)
+                if not os.path.isabs(pattern):
+                    pattern = os.path.join(f'{lPaths.home}/.ssh', pattern)
+                # New file in include directory changes directory mtime.
+                stats[os.path.dirname(pattern)] = ssh_config_stat(os.path.dirname(pattern))
+                for include_path in sorted(glob.glob(pattern)):
+                    blocks_count = len(blocks)
+                    read_ssh_config_file(include_path, blocks, stats, depth + 1, include_conditions)
+                    if len(blocks) != blocks_count:
+                        # Next file and lines after Include are in the current block again. It's a new block
+                        # after included ones, so options of included blocks are still obtained first.
+                        blocks.append([patterns, {}, block_conditions])
+        elif keyword in SSH_CONFIG_OPTIONS and arguments:
+            # The first obtained value is used.
+            blocks[-1][1].setdefault(keyword, arguments[0])
+
+
+def ssh_pattern_match(host, patterns):
+    """
+    Matches host with Host patterns. Negated pattern "!pattern" excludes host, even if other pattern matches.
+    """
+    matched = False
+    for pattern in patterns:
+        if pattern.startswith('!'):
+            if fnmatch.fnmatchcase(host, pattern[1:]):
+                return False
+        elif fnmatch.fnmatchcase(host, pattern):
+            matched = True
+    return matched
+
+
+def ssh_block_match(host, block, literal=False):
+    """
+    Matches host with Host block and blocks, that include it. With literal, host is known to be in block's
+    patterns, only enclosing blocks are matched.
+    """
+    patterns, _, conditions = block
+    return (literal or ssh_pattern_match(host, patterns)) and all(
+        ssh_pattern_match(host, condition) for condition in conditions)
+
+
+def parse_ssh_config(path):
+    """
+    Parses ssh config with all included files. Returns (hosts, stats): hosts is dict of host aliases in order
+    of appearance with their hostname, port and user, resolved like ssh does (the first obtained value wins),
+    stats are used to check if config has changed.
+    """
+    stats = {}
+    blocks = [[['*'], {}, ()]]
+    read_ssh_config_file(path, blocks, stats)
+
+    # Host aliases are only patterns without wildcards. Blocks with wildcards apply to them by matching.
+    literal_blocks = {}
+    wildcard_blocks = []
+    for block_index, (patterns, options, _) in enumerate(blocks):
+        # Blocks without options, e.g. Host * after every Include, change nothing, they aren't matched.
+        if options and any(character in pattern for pattern in patterns for character in '*?!'):
+            wildcard_blocks.append(block_index)
+        for pattern in patterns:
+            if not any(character in pattern for character in '*?!'):
+                literal_blocks.setdefault(pattern, []).append(block_index)
+
+    hosts = {}
+    for host, host_blocks in literal_blocks.items():
+        host_blocks = [block_index for block_index in host_blocks
+                       if ssh_block_match(host, blocks[block_index], literal=True)]
+        if not host_blocks:
+            # Host is only in files included inside Host blocks, that don't match it. ssh doesn't know it.
+            continue
+        options = {}
+        matched_blocks = host_blocks + [
+            block_index for block_index in wildcard_blocks if ssh_block_match(host, blocks[block_index])
+        ]
+        for block_index in sorted(set(matched_blocks)):
+            for keyword, value in blocks[block_index][1].items():
+                options.setdefault(keyword, value)
+        hosts[host] = {
+            'hostname': options.get('hostname', host).replace('%h', host),
+            'port': int(options['port']) if options.get('port', '').isdigit() else 22,
+            'user': options.get('user'),
+        }
+    return hosts, stats
+
+
+def ssh_config():
+    """
+    Returns ssh config hosts dict (see parse_ssh_config), None if there is no ssh config.
+    Config is parsed again only if ssh config or any included file has changed.
+    """
+    if not os.path.exists(lPaths.ssh_config):
+        return None
+    cached = ssh_config_cache.get(lPaths.ssh_config)
+    if cached is not None and all(ssh_config_stat(path) == stat for path, stat in cached[1].items()):
+        return cached[0]
+    hosts, stats = parse_ssh_config(lPaths.ssh_config)
+    ssh_config_cache[lPaths.ssh_config] = (hosts, stats)
+    return hosts
+
+
+def ssh_config_hosts():
+    """
+    Get .ssh/config hosts. Return list of hostnames.
+    """
+    hosts = ssh_config()
+    if hosts is None:
+        return None
+    return list(hosts)
+
+
+def short_word(word, terminal_width=None):
+    """
+    This is for tmux menus. Tmux menu will not show, if it's content is to big for terminal window.
+    This function shortens words for them to fit in window. Menus with many words should get window width
+    once and pass it.
+    """
+    if terminal_width is None:
+        terminal_width = window_width()
+
+    if len(word) > 53:
+        word_short = word[:50] + '...'
+    else:
+        word_short = word
+    if len(word_short) >= terminal_width:
+        word_short = word_short[:terminal_width - 20] + '...'
+
+    return word_short
 
 
-def save_pane_history(output_file_name, pane_id=':', pipe='o', only_once=False):
+def window_width():
     """
-    Saves whole pane history to a file.
+    Returns width of the current window.
     """
-    for _ in pipe:
-        output = subprocess.check_output([
-            'tmux', 'capture-pane', '-J', '-p', '-S', '-20000', '-t', pane_id
-        ], encoding='UTF-8')
-        if output == '':
-            continue
-        with open(output_file_name, 'w') as f:
-            f.write(output)
-        if only_once:
-            break
-        time.sleep(1)
+    return int(tmux('display-message', '-p', '#{window_width}'))
 
 
-def pane_log(connection_type, host, restart=False):
+def menu_key(index):
     """
-    Toggle pane log.
+    Returns menu shortcut key for item with zero based index: 1-9, 0, M-1..M-0, C-1..C-0, or '' after that.
     """
-    sessions_metadata = load_sessions_metadata()
-    if connection_type == 'l':
-        last_session_index = '--'
-    else:
-        last_session_index = sessions_metadata['last_session_index']
-    year = datetime.datetime.now().strftime("%Y")
-    month = datetime.datetime.now().strftime("%m")
-    day = datetime.datetime.now().strftime("%d")
-    current_time = datetime.datetime.now().strftime("%H_%M_%S")
-    log_filename = (f'{lPaths.log_dir}/{year}/{month}/{day}/{current_time}'
-                    f'---!{last_session_index}_{connection_type}_{host}.log')
-    create_dir(log_filename)
+    prefix = ['', 'M-', 'C-']
+    if index >= 30:
+        return ''
+    return f'{prefix[index // 10]}{(index + 1) % 10}'
 
-    subprocess.run([
-        'tmux',
-        'pipe-pane',
-        '-o',
-        f'{lPaths.script} save_pane_history --file_name "{log_filename}" --pane_id #{{pane_id}} -i -'
-    ], check=True)
-    if restart:
-        subprocess.run([
-            'tmux',
-            'pipe-pane',
-            '-o',
-            f'{lPaths.script} save_pane_history --file_name "{log_filename}" --pane_id #{{pane_id}} -i -'
-        ], check=True)
 
-
-def search_logs():
+def ssh_host_group(host):
     """
-    grep in log directory.
+    Returns group of host for SSH Config Hosts menu: domain for hosts with domain, otherwise letters
+    in the beginning of the host name.
     """
-    rename_window()
-    query = input(f'{ANSIColors.WARNING}grep in logs:{ANSIColors.ENDC} ')
-    if not query.isspace() and query != "":
-        subprocess.run(
-            ['grep', '--color=always', '-n', '-r', query, '.'],
-            cwd=f'{lPaths.home}/tmuxNOC/local/log/',
-            check=True
-        )
-    else:
-        print(f'{ANSIColors.FAIL}Empty query.{ANSIColors.ENDC}')
-    search_logs()
+    if '.' in host and not host.replace('.', '').isdigit():
+        return host.split('.', 1)[1]
+    if host.replace('.', '').isdigit():
+        return host.rsplit('.', 1)[0] + '.*'
+    match = re.match(r'[^\W\d_]+', host)
+    if match is None:
+        return host[:1]
+    return match.group(0)
 
 
-def tmux_dm(message):
+def ssh_menu(split_direction, group=None, page=0):
     """
-    Display message in status line.
+    Show ssh menu with hosts from .ssh/config. If hosts don't fit on one page, they are grouped by domain.
+    Groups and hosts are paged.
     """
-    subprocess.run(['tmux', 'display-message', message], check=True)
+    tmux(*ssh_menu_command(split_direction, group, page, window_width()))
 
 
-def tmux_set_pane_name(name):
+def ssh_menu_command(split_direction, group, page, terminal_width):
     """
-    Setting pane name.
+    Returns display-menu command of ssh menu, see ssh_menu.
     """
-    subprocess.run(['tmux', 'set', '-p', '@pane_name', name], check=True)
+    settings = load_settings()
+    reachability = load_reachability()
+    page_size = settings['ssh_menu_page_size']
+    page = int(page or 0)
+    ssh_hosts_list = ssh_config_hosts() or []
+    menu_command = f'{lPaths.client} ssh_menu --split_direction {split_direction}'
+
+    groups = {}
+    if group is None and len(ssh_hosts_list) > page_size:
+        for host in ssh_hosts_list:
+            groups.setdefault(ssh_host_group(host), []).append(host)
+    if len(groups) > 1:
+        title = 'SSH Config Hosts'
+        items = [
+            (f'{short_word(name, terminal_width)} ({len(hosts)})',
+             f'run "{menu_command} --group \'{name}\'"')
+            for name, hosts in sorted(groups.items())
+        ]
+    else:
+        if group is not None:
+            title = f'SSH Config Hosts: {group}'
+            ssh_hosts_list = [host for host in ssh_hosts_list if ssh_host_group(host) == group]
+        else:
+            title = 'SSH Config Hosts'
+        items = [
+            (short_word(host, terminal_width) + reachability_label('ssh', host, reachability, settings),
+             (f'run "{lPaths.client} connect_ssh --host \'{host}\' '
+              f'--split_direction {split_direction}"'))
+            for host in ssh_hosts_list
+        ]
+
+    pages = max((len(items) + page_size - 1) // page_size, 1)
+    page = min(max(page, 0), pages - 1)
+    if pages > 1:
+        title += f' {page + 1}/{pages}'
+    command = [
+        'display-menu',
+        '-T', f'#[align=centre]{title}',
+        '-x', 'P',
+        '-y', 'S',
+    ]
+    for index, (name, action) in enumerate(items[page * page_size:(page + 1) * page_size]):
+        command += [name, menu_key(index), action]
+
+    page_command = menu_command
+    if group is not None:
+        page_command += f" --group '{group}'"
+    navigation = []
+    if page > 0:
+        navigation += ['Previous Page', 'p', f'run "{page_command} --page {page - 1}"']
+    if page + 1 < pages:
+        navigation += ['Next Page', 'n', f'run "{page_command} --page {page + 1}"']
+    if group is not None:
+        navigation += ['All Groups', 'g', f'run "{menu_command}"']
+    if navigation:
+        command += [''] + navigation
+    return command
 
 
-def open_log(history_index, split_direction):
+def host_trigrams(name):
     """
-    Open log file in less.
+    Returns set of three character substrings of the name.
     """
-    log_file = None
-    for path in Path(lPaths.log_dir).rglob(f'*!{history_index}*'):
-        log_file = str(path)
-    if log_file is None:
-        tmux_dm(f'Log file with index {history_index} not found.')
-    else:
-        log_file_short = log_file.replace(lPaths.log_dir + '/', '')
-        subprocess.run(get_split_command(split_direction) + [f'less -m "{log_file}"'], check=True)
-        tmux_set_pane_name(f'Log:{log_file_short}')
-        rename_window()
+    return {name[index:index + 3] for index in range(len(name) - 2)}
 
 
-def load_sessions_metadata():
-    if not os.path.exists(lPaths.sessions_metadata):
-        return {}
-    with open(lPaths.sessions_metadata, 'r') as f:
-        sessions = json.load(f)
-    return sessions
+# Trigram lists of the query are intersected, the rarest first, until there are this few candidates. Then
+# names of candidates are checked, it's faster than to intersect the rest of the lists. Lists of more than
+# half of hosts are not intersected at all, they remove too few.
+HOST_SEARCH_CHECK_SIZE = 1000
+# Not more than this many hosts are checked for fuzzy match.
+HOST_SEARCH_FUZZY_SIZE = 2000
 
 
-def save_session(connection_type, host):
+class HostIndex:
     """
-    Saves information about session and updates metadata.
+    Trigram index of known hosts for fuzzy search. Hosts with every word of the query as substring are the
+    best, the ones that start with it first, then shorter ones. They are found by intersection of trigram
+    lists, so query doesn't scan all hosts. If there are not enough of them, hosts with the query as
+    subsequence of characters and then hosts with at least half of query trigrams are added. They are
+    taken from the rarest trigram lists. Words of the query, separated by spaces, are matched separately.
     """
-    sessions_metadata = load_sessions_metadata()
-    if 'last_session_index' in sessions_metadata:
-        sessions_metadata['last_session_index'] += 1
-    else:
-        sessions_metadata['last_session_index'] = 1
-    if 'last_five_sessions' in sessions_metadata:
-        last_five_sessions = sessions_metadata['last_five_sessions']
-        if host not in str(last_five_sessions):
-            if len(last_five_sessions) >= 5:
-                last_five_sessions.pop(4)
-            last_five_sessions.insert(0, {
-                'connection_type': connection_type,
-                'host': host
-            })
+    def __init__(self, hosts):
+        # hosts is a list of (connection_type, host), the most important first.
+        self.hosts = hosts
+        self.names = [host.lower() for _, host in hosts]
+        self.trigrams = None
+        self.length_rank = None
+        self.by_length = None
+        self.sorted_names = None
+
+    def build(self):
+        """
+        Builds the index. It's done separately, so the list of hosts can be shown before it's ready.
+        """
+        trigrams = {}
+        for host_id, name in enumerate(self.names):
+            for trigram in host_trigrams(name):
+                trigrams.setdefault(trigram, []).append(host_id)
+        # Order of equally good matches: shorter first, then more important.
+        by_length = sorted(range(len(self.names)), key=[len(name) for name in self.names].__getitem__)
+        length_rank = [0] * len(self.names)
+        for rank, host_id in enumerate(by_length):
+            length_rank[host_id] = rank
+        self.sorted_names = sorted(zip(self.names, range(len(self.names))))
+        self.by_length = by_length
+        self.length_rank = length_rank
+        self.trigrams = trigrams
+
+    def substring_matches(self, words, candidates, limit):
+        """
+        Returns up to limit ids of candidate hosts with every word as substring, ones that start with the first
+        word first, then shorter ones. If there are many candidates, they are not checked one by one: names,
+        that start with the first word, are found by binary search in sorted names, and the rest are checked
+        in order of length only until there are enough of them.
+        """
+        names = self.names
+        first = words[0]
+        if len(candidates) <= HOST_SEARCH_CHECK_SIZE:
+            found = list(candidates)
+            for word in words:
+                found = [host_id for host_id in found if word in names[host_id]]
+            starting = [host_id for host_id in found if names[host_id].startswith(first)]
+            ranked = heapq.nsmallest(limit, starting, key=self.length_rank.__getitem__)
+            rest = [host_id for host_id in found if not names[host_id].startswith(first)]
+            return ranked + heapq.nsmallest(limit - len(ranked), rest, key=self.length_rank.__getitem__)
+
+        start = bisect.bisect_left(self.sorted_names, (first,))
+        end = bisect.bisect_left(self.sorted_names, (first + '\U0010ffff',))
+        if end - start <= HOST_SEARCH_CHECK_SIZE:
+            starting = [host_id for name, host_id in self.sorted_names[start:end]
+                        if host_id in candidates and all(word in name for word in words[1:])]
+            ranked = heapq.nsmallest(limit, starting, key=self.length_rank.__getitem__)
         else:
-            last_connection = None
-            for index, session in enumerate(last_five_sessions):
-                if connection_type == session['connection_type'] and host == session['host']:
-                    last_connection = index
-            if last_connection is None:
-                if len(last_five_sessions) >= 5:
-                    last_five_sessions.pop(4)
-                last_five_sessions.insert(0, {
-                    'connection_type': connection_type,
-                    'host': host
-                })
-            else:
-                last_five_sessions.pop(last_connection)
-                last_five_sessions.insert(0, {
-                    'connection_type': connection_type,
-                    'host': host
-                })
+            starting = (host_id for host_id in self.by_length if names[host_id].startswith(first)
+                        and host_id in candidates and all(word in names[host_id] for word in words[1:]))
+            ranked = list(itertools.islice(starting, limit))
+        rest = (host_id for host_id in self.by_length if host_id in candidates
+                and not names[host_id].startswith(first) and all(word in names[host_id] for word in words))
+        return ranked + list(itertools.islice(rest, limit - len(ranked)))
 
-    else:
-        last_five_sessions = [{
-            'connection_type': connection_type,
-            'host': host
-        }]
-    sessions_metadata['last_five_sessions'] = last_five_sessions
-    sessions_metadata[f'last_{connection_type}_session'] = host
-    with open(lPaths.sessions_metadata, 'w') as f:
-        json.dump(sessions_metadata, f)
-
-    if not os.path.exists(lPaths.sessions_history):
-        create_dir(lPaths.sessions_history)
-        with open(lPaths.sessions_history, 'w'):
-            pass
-    with open(lPaths.sessions_history, 'r+') as sessions_history_file:
-        sessions_history = sessions_history_file.read()
-        current_date = datetime.datetime.now().strftime("%d.%m.%Y")
-        current_time = datetime.datetime.now().strftime("%H:%M:%S")
-        if f'# {current_date}' not in sessions_history:
-            sessions_history_file.write(f'# {current_date}\n')
-        sessions_history_file.write(
-            f'    {sessions_metadata["last_session_index"]} {current_date} {current_time} {connection_type} {host}\n'
-        )
+    def search(self, query, limit):
+        """
+        Returns up to limit (connection_type, host) for the query.
+        """
+        words = query.lower().split()
+        if not words:
+            return self.hosts[:limit]
+        if self.trigrams is None:
+            self.build()
+        names = self.names
+        length_rank = self.length_rank
+        trigrams = set().union(*(host_trigrams(word) for word in words))
+        postings = sorted((self.trigrams.get(trigram, ()) for trigram in trigrams), key=len)
+        candidates = set(postings[0]) if postings else range(len(names))
+        for posting in postings[1:]:
+            if len(candidates) <= HOST_SEARCH_CHECK_SIZE or len(posting) > len(names) // 2:
+                break
+            candidates = candidates.intersection(posting)
+        ranked = self.substring_matches(words, candidates, limit)
+        if len(ranked) == limit or not trigrams:
+            return [self.hosts[host_id] for host_id in ranked]
+
+        # Hosts with at least half of query trigrams are in one of these rarest lists. Lists are in order of
+        # importance, so if there are too many hosts, the most important are taken.
+        minimum = (len(trigrams) + 1) // 2
+        fuzzy = set()
+        for posting in postings[:len(postings) - minimum + 1]:
+            fuzzy.update(posting[:HOST_SEARCH_FUZZY_SIZE - len(fuzzy)])
+            if len(fuzzy) >= HOST_SEARCH_FUZZY_SIZE:
+                break
+        fuzzy.difference_update(ranked)
+        fuzzy_ranked = []
+        for host_id in fuzzy:
+            name = names[host_id]
+            common = sum(trigram in name for trigram in trigrams)
+            if common >= minimum:
+                match = all(is_subsequence(word, name) for word in words)
+                fuzzy_ranked.append((not match, -common, length_rank[host_id], host_id))
+        ranked += [rank[3] for rank in heapq.nsmallest(limit - len(ranked), fuzzy_ranked)]
+        return [self.hosts[host_id] for host_id in ranked]
 
 
-def ssh_config_hosts():
+def is_subsequence(query, name):
     """
-    Get .ssh/config hosts. Return list of hostnames.
+    Checks if all characters of the query are in the name in the same order.
     """
-    if not os.path.exists(f'{lPaths.home}/.ssh/config'):
-        return None
+    characters = iter(name)
+    return all(character in characters for character in query)
 
-    with open(f'{lPaths.home}/.ssh/config') as f:
-        ssh_config = f.readlines()
+
+def read_hosts_file(filename):
+    """
+    Returns list of (connection_type, host) from hosts file. File has one host per line, optionally with
+    connection type before it: "telnet 10.0.0.1". Host without connection type is ssh host.
+    Everything after # is a comment.
+    """
     hosts = []
-    for line in ssh_config:
-        if line.startswith('Host'):
-            hosts.append(line.replace('Host ', '').replace('\n', ''))
+    for line in read_cached(filename, lambda f: f.readlines()):
+        fields = line.split('#', 1)[0].split()
+        if len(fields) == 1:
+            hosts.append(('ssh', fields[0]))
+        elif len(fields) == 2 and fields[0] in ('ssh', 'telnet'):
+            hosts.append((fields[0], fields[1]))
     return hosts
 
 
-def short_word(word):
+def known_hosts():
     """
-    This is for tmux menus. Tmux menu will not show, if it's content is to big for terminal window.
-    This function shortens words for them to fit in window.
+    Returns list of unique (connection_type, host) from sessions journal, the latest first, ssh config and
+    inventory file (see read_hosts_file).
     """
-    terminal_width = int(subprocess.check_output([
-        'tmux',
-        'display-message',
-        '-p',
-        '#{window_width}'
-    ], encoding='UTF-8'))
-
-    if len(word) > 53:
-        word_short = word[:50] + '...'
-    else:
-        word_short = word
-    if len(word_short) >= terminal_width:
-        word_short = word_short[:terminal_width - 20] + '...'
-
-    return word_short
+    hosts = {}
+    for entry in reversed(list(read_sessions_journal())):
+        hosts.setdefault((entry['connection_type'], entry['host']), None)
+    for host in ssh_config_hosts() or []:
+        hosts.setdefault(('ssh', host), None)
+    if os.path.exists(lPaths.inventory):
+        for host in read_hosts_file(lPaths.inventory):
+            hosts.setdefault(host, None)
+    return list(hosts)
 
 
-def ssh_menu(split_direction):
+def find_host():
     """
-    Show ssh menu with hosts from .ssh/config.
+    Fuzzy search of known hosts. Results are updated on every key press, Up/Down or Ctrl-P/Ctrl-N select host,
+    Tab switches between ssh and telnet, Enter connects in this pane, Esc or Ctrl-C exits.
     """
-    command = [
-        'tmux', 'display-menu',
-        '-T', '#[align=centre]SSH Config Hosts',
-        '-x', 'P',
-        '-y', 'S',
-    ]
-    ssh_hosts_list = ssh_config_hosts()
-    if ssh_hosts_list is not None:
-        for index, host in enumerate(ssh_hosts_list):
-            index += 1
-            if index == 10:
-                index = 0
-            elif 20 > index > 10:
-                index = f'M-{index - 10}'
-            elif index == 20:
-                index = 'M-0'
-            elif 30 > index > 20:
-                index = f'C-{index - 20}'
-            elif index == 30:
-                index = 'C-0'
-            command += [
-                short_word(host),
-                str(index),
-                (f'run "{lPaths.script} connect_ssh --host \'{host}\' '
-                 f'--split_direction {split_direction}"'),
+    rename_window()
+    index = HostIndex(known_hosts())
+    file_descriptor = sys.stdin.fileno()
+    terminal_settings = termios.tcgetattr(file_descriptor)
+    query = ''
+    selected = 0
+    selected_type = None
+    try:
+        tty.setcbreak(file_descriptor)
+        while True:
+            columns, rows = shutil.get_terminal_size()
+            results = index.search(query, max(rows - 2, 1))
+            selected = min(selected, max(len(results) - 1, 0))
+            screen = [
+                f'\x1b[H{ANSIColors.WARNING}find host:{ANSIColors.ENDC} {query}\x1b[K',
+                f'{ANSIColors.OKBLUE}{len(results)} of {len(index.hosts)} hosts{ANSIColors.ENDC}\x1b[K',
             ]
-    subprocess.run(command, check=True)
+            for result_index, (connection_type, host) in enumerate(results):
+                if result_index == selected and selected_type is not None:
+                    connection_type = selected_type
+                line = f'{connection_type:7}{host}'[:columns - 1]
+                if result_index == selected:
+                    line = f'\x1b[7m{line}\x1b[0m'
+                screen.append(f'{line}\x1b[K')
+            # Cursor is left at the end of the query.
+            sys.stdout.write('\r\n'.join(screen) + f'\x1b[J\x1b[1;{len(query) + 12}H')
+            sys.stdout.flush()
+
+            # Index is built after the first screen is shown, keys pressed meanwhile are not lost.
+            if index.trigrams is None:
+                index.build()
+            # Everything, that was typed since the last redraw, is handled at once.
+            keys = os.read(file_descriptor, 1024)
+            while select.select([file_descriptor], [], [], 0)[0]:
+                keys += os.read(file_descriptor, 1024)
+            keys = keys.decode(errors='ignore')
+            while keys:
+                if keys.startswith(('\x1b[A', '\x1bOA')) or keys[0] == '\x10':
+                    selected = max(selected - 1, 0)
+                    selected_type = None
+                elif keys.startswith(('\x1b[B', '\x1bOB')) or keys[0] == '\x0e':
+                    selected += 1
+                    selected_type = None
+                elif keys == '\x1b':
+                    return
+                elif keys[0] in '\r\n':
+                    if results:
+                        connection_type, host = results[selected]
+                        connection_type = selected_type or connection_type
+                        # This pane is replaced with the connection, it's kept after we exit, until it's respawned.
+                        pane_id = os.environ['TMUX_PANE']
+                        tmux_batch([
+                            ['set', '-p', '-t', pane_id, 'remain-on-exit', 'on'],
+                            ['run-shell', '-b', (f"{lPaths.client} connect_{connection_type} --host '{host}' "
+                                                 f"--split_direction reopen --pane_id {pane_id}")],
+                        ])
+                    return
+                elif keys[0] == '\t':
+                    if results:
+                        current_type = selected_type or results[selected][0]
+                        selected_type = 'telnet' if current_type == 'ssh' else 'ssh'
+                elif keys[0] in '\x7f\x08':
+                    query = query[:-1]
+                elif keys[0] == '\x15':
+                    query = ''
+                elif keys[0] == '\x17':
+                    query = query.rstrip().rpartition(' ')[0]
+                elif keys[0].isprintable():
+                    query += keys[0]
+                if keys[0] in '\x7f\x08\x15\x17' or keys[0].isprintable():
+                    selected = 0
+                    selected_type = None
+                if keys.startswith('\x1b'):
+                    keys = re.sub(r'^\x1b(?:\[[0-?]*[ -/]*[@-~]|O.|.?)', '', keys, count=1, flags=re.S)
+                else:
+                    keys = keys[1:]
+    except KeyboardInterrupt:
+        pass
+    finally:
+        termios.tcsetattr(file_descriptor, termios.TCSADRAIN, terminal_settings)
+        sys.stdout.write('\x1b[H\x1b[J')
+        sys.stdout.flush()
 
 
 def clipboard_menu(split_direction):
     """
     Show menu with options to connect to first word in clipboard.
     """
-    clipboard_first_line = subprocess.check_output(lPaths.paste, encoding='UTF-8').split('\n')[0]
+    with trace_span('spawn', 'paste'):
+        clipboard_first_line = subprocess.check_output(lPaths.paste, encoding='UTF-8').split('\n')[0]
     clipboard_first_word = [word for word in clipboard_first_line.split(' ') if len(word) != 0]
     if len(clipboard_first_word) != 0:
         clipboard_first_word = clipboard_first_word[0]
         clipboard_first_word_short = short_word(clipboard_first_word)
-        subprocess.run([
-            'tmux', 'display-menu',
+        settings = load_settings()
+        reachability = load_reachability()
+        telnet_label = reachability_label('telnet', clipboard_first_word, reachability, settings)
+        ssh_label = reachability_label('ssh', clipboard_first_word, reachability, settings)
+        tmux(
+            'display-menu',
             '-T', '#[align=centre]Clipboard',
             '-x', 'P',
             '-y', 'S',
-            f'telnet {clipboard_first_word_short}', 'v',
-            (f'run "{lPaths.script} connect_telnet '
+            f'telnet {clipboard_first_word_short}{telnet_label}', 'v',
+            (f'run "{lPaths.client} connect_telnet '
              f'--host \'{clipboard_first_word}\' --split_direction {split_direction}"'),
 
-            f'ssh {clipboard_first_word_short}', 'V',
-            (f'run "{lPaths.script} connect_ssh '
+            f'ssh {clipboard_first_word_short}{ssh_label}', 'V',
+            (f'run "{lPaths.client} connect_ssh '
              f'--host \'{clipboard_first_word}\' --split_direction {split_direction}"'),
-        ], check=True)
+        )
     else:
         tmux_dm('No content in clipboard.')
 
@@ -338,55 +2503,61 @@ def move_pane_window(split_direction):
     else:
         return
 
-    windows_list = subprocess.check_output(
-        ['tmux', 'list-windows', '-F', "#I&&&#W&&&#{window_id}"],
-        encoding='utf-8'
-    ).split('\n')[:-1]
+    windows_list = tmux('list-windows', '-F', "#I&&&#W&&&#{window_id}").split('\n')[:-1]
 
+    terminal_width = window_width()
     windows_menu = []
     for window in windows_list:
         index, name, _id = window.split('&&&')
-        windows_menu.append(f'{index}:{short_word(name)}')
+        windows_menu.append(f'{index}:{short_word(name, terminal_width)}')
         if int(index) < 10:
             windows_menu.append(index)
         else:
             windows_menu.append('')
         windows_menu.append(
-            f'join-pane {split_argument} -t {_id}; run "{lPaths.script} rename_windows"'
+            f'join-pane {split_argument} -t {_id}; run "{lPaths.client} rename_windows"'
             )
 
-    subprocess.run([
-        'tmux',
+    tmux(
         'display-menu',
         '-T', '#[align=centre]Move Pane to:',
         '-x', 'P',
         '-y', 'S',
-    ] + windows_menu, check=True)
+        *windows_menu
+    )
 
 
 def noc_menu(split_direction='new'):
     """
     Show main tmuxNOC menu.
     """
+    tmux(*noc_menu_command(split_direction, window_width()))
+
+
+def noc_menu_command(split_direction, terminal_width, prerendered=False):
+    """
+    Returns display-menu command of main tmuxNOC menu. Pre-rendered menu opens other pre-rendered menus.
+    """
     script_path = lPaths.script
+    client_path = lPaths.client
 
     if ssh_config_hosts() is None:
         ssh_config_hosts_exists = False
     else:
         ssh_config_hosts_exists = True
 
-    sessions_metadata = load_sessions_metadata()
-    if 'last_five_sessions' in sessions_metadata:
-        last_five_sessions = sessions_metadata['last_five_sessions']
+    settings = load_settings()
+    reachability = load_reachability()
+    last_sessions = recent_sessions(load_sessions_metadata(), settings)
+    if last_sessions:
         last_sessions_menu_block = ['']
-        for index, session in enumerate(last_five_sessions):
-            connection_type = session['connection_type']
-            host = session['host']
-            host_short = short_word(host)
-            last_sessions_menu_block.append(f'{connection_type} {host_short}')
-            last_sessions_menu_block.append(f'{index + 1}')
+        for index, (connection_type, host) in enumerate(last_sessions):
+            host_short = short_word(host, terminal_width)
+            label = reachability_label(connection_type, host, reachability, settings)
+            last_sessions_menu_block.append(f'{connection_type} {host_short}{label}')
+            last_sessions_menu_block.append(f'{index + 1}' if index < 9 else '')
             last_sessions_menu_block.append(
-                (f'run "{script_path} connect_{connection_type} '
+                (f'run "{client_path} connect_{connection_type} '
                  f'--host \'{host}\' --split_direction {split_direction}"')
             )
     else:
@@ -396,150 +2567,719 @@ def noc_menu(split_direction='new'):
         split_command = 'split-window -v'
         split_name = 'Vertical'
         split_variants = [
-            'Split Horizontal', '\\', f'run "{script_path} noc_menu --split_direction horizontal"',
-            'Open in New Window', 'n', f'run "{script_path} noc_menu --split_direction new"',
-            'Open in Current Pane', 'r', f'run "{script_path} noc_menu --split_direction reopen"',
+            'Split Horizontal', '\\', show_menu_command('noc_menu', 'horizontal', prerendered),
+            'Open in New Window', 'n', show_menu_command('noc_menu', 'new', prerendered),
+            'Open in Current Pane', 'r', show_menu_command('noc_menu', 'reopen', prerendered),
             '',
         ]
     elif split_direction == 'horizontal':
         split_command = 'split-window -h'
         split_name = 'Horizontal'
         split_variants = [
-            'Split Vertical', '-', f'run "{script_path} noc_menu --split_direction vertical"',
-            'Open in New Window', 'n', f'run "{script_path} noc_menu --split_direction new"',
-            'Open in Current Pane', 'r', f'run "{script_path} noc_menu --split_direction reopen"',
+            'Split Vertical', '-', show_menu_command('noc_menu', 'vertical', prerendered),
+            'Open in New Window', 'n', show_menu_command('noc_menu', 'new', prerendered),
+            'Open in Current Pane', 'r', show_menu_command('noc_menu', 'reopen', prerendered),
             '',
         ]
     elif split_direction == 'reopen':
         split_command = 'respawn-pane -k'
         split_name = 'Open in Current Pane'
         split_variants = [
-            'Split Vertical', '-', f'run "{script_path} noc_menu --split_direction vertical"',
-            'Split Horizontal', '\\', f'run "{script_path} noc_menu --split_direction horizontal"',
-            'Open in New Window', 'n', f'run "{script_path} noc_menu --split_direction new"',
+            'Split Vertical', '-', show_menu_command('noc_menu', 'vertical', prerendered),
+            'Split Horizontal', '\\', show_menu_command('noc_menu', 'horizontal', prerendered),
+            'Open in New Window', 'n', show_menu_command('noc_menu', 'new', prerendered),
             '',
         ]
     else:
         split_command = 'new-window'
         split_name = 'New Window'
         split_variants = [
-            'Split Vertical', '-', f'run "{script_path} noc_menu --split_direction vertical"',
-            'Split Horizontal', '\\', f'run "{script_path} noc_menu --split_direction horizontal"',
-            'Open in Current Pane', 'r', f'run "{script_path} noc_menu --split_direction reopen"',
+            'Split Vertical', '-', show_menu_command('noc_menu', 'vertical', prerendered),
+            'Split Horizontal', '\\', show_menu_command('noc_menu', 'horizontal', prerendered),
+            'Open in Current Pane', 'r', show_menu_command('noc_menu', 'reopen', prerendered),
             '',
         ]
 
-    command = [
-        'tmux', 'display-menu',
-        '-T', f'#[align=centre]NOC {split_name}',
-        '-x', 'P',
-        '-y', 'S',
-    ] + split_variants + [
-        'Move Pane to Window - Vertical', 'm',
-        f'run "{script_path} move_pane_window --split_direction vertical"',
+    command = [
+        'display-menu',
+        '-T', f'#[align=centre]NOC {split_name}',
+        '-x', 'P',
+        '-y', 'S',
+    ] + split_variants + [
+        'Move Pane to Window - Vertical', 'm',
+        f'run "{client_path} move_pane_window --split_direction vertical"',
+
+        'Move Pane to Window - Horizontal', 'M',
+        f'run "{client_path} move_pane_window --split_direction horizontal"',
+        '',
+        # -----
+        'Show Sessions History', 'h',
+        (f'{split_command} "{script_path} sessions_history | less +G"; '
+         f'set -p @pane_name "Sessions History"; run "{client_path} rename_window"'),
+
+        'Open Log File', 'l',
+        (f'command-prompt -p "Open Log Number [HH:MM:SS]:" \'run "{client_path} open_log '
+         f'--history_index \\"%1\\" --split_direction {split_direction}"\''),
+
+        'Search in Logs', 'L',
+        f'{split_command} "{script_path} search_logs"; set -p @pane_name "grep in logs"',
+
+        'Log Commands', 'c',
+        (f'command-prompt -p "Log Number:" \'{split_command} "{script_path} log_commands --history_index %1"; '
+         f'set -p @pane_name "log commands %1"\''),
+        # -----
+    ]
+    command += ['']
+    if split_direction == 'new':
+        command += [
+            'Send Commands with Delay', 'd',
+            (f'split-window -h "{script_path} send_with_delay '
+             f'--pane_id $(tmux display -pt - \'#{{pane_id}}\')"'),
+        ]
+    command += [
+        'Bulk Connect', 'B',
+        ('command-prompt -p "Hosts (file, ssh:pattern or recent:N):" '
+         f'\'run "{client_path} bulk_connect --hosts \\"%1\\""\''),
+
+        'Run Commands on Hosts', 'R',
+        f'{split_command} "{script_path} run_on_hosts"',
+
+        'Save Workspace', 'w',
+        f'run "{client_path} snapshot"',
+
+        'Restore Workspace', 'W',
+        f'confirm-before -p "Restore windows of the previous tmux server? (y/n)" \'run "{client_path} restore"\'',
+    ]
+    command += [
+        # -----
+        '',
+        'Connect from Clipboard', 'v',
+        f'run "{client_path} clipboard_menu --split_direction {split_direction}"',
+
+        'New Telnet', 'q',
+        (f'run "{client_path} setup_connection --connection_type telnet '
+         f'--split_direction {split_direction}"'),
+
+        'New SSH', 's',
+        (f'run "{client_path} setup_connection --connection_type ssh '
+         f'--split_direction {split_direction}"'),
+    ]
+    command += [
+        'Find Host', 'f',
+        f'{split_command} "{script_path} find_host"; set -p @pane_name "find host"',
+    ]
+    if ssh_config_hosts_exists:
+        command += [
+            'SSH Config Hosts', 'S',
+            show_menu_command('ssh_menu', split_direction, prerendered),
+        ]
+    if settings['ssh_multiplexing']:
+        command += [
+            'SSH Connections Pool', 'P',
+            f'{split_command} "{script_path} ssh_pool | less"; set -p @pane_name "ssh pool"',
+        ]
+    if last_sessions_menu_block is not None:
+        command += last_sessions_menu_block
+    return command
+
+
+# Menus are pre-rendered for every split direction.
+MENU_SPLIT_DIRECTIONS = ['new', 'vertical', 'horizontal', 'reopen']
+# Pre-rendered menus are shown only in windows of at least this width, see short_word. In narrower windows
+# tmux.conf key binding runs noc_menu.
+PRERENDERED_MENU_MIN_WIDTH = 54
+# Inputs of the pre-rendered menus, that they were rendered from in this process. daemon is True in daemon,
+# which renders menus again itself.
+menus_state = {'inputs': None, 'daemon': False}
+
+
+def menu_file(menu, split_direction):
+    return f'{lPaths.menus}/{menu}_{split_direction}.conf'
+
+
+def show_menu_command(menu, split_direction, prerendered=False):
+    """
+    Returns tmux command for menu item, that shows another menu: sources pre-rendered menu or runs subcommand.
+    """
+    if prerendered:
+        return f'source-file {tmux_quote(menu_file(menu, split_direction))}'
+    return f'run "{lPaths.client} {menu} --split_direction {split_direction}"'
+
+
+def menus_inputs():
+    """
+    Returns stats of the files, that menus are rendered from: sessions metadata, settings, reachability
+    cache, ssh config and files included from it.
+    """
+    ssh_config()
+    cached = ssh_config_cache.get(lPaths.ssh_config)
+    return (
+        ssh_config_stat(lPaths.sessions_metadata),
+        ssh_config_stat(lPaths.settings),
+        ssh_config_stat(lPaths.reachability),
+        ssh_config_stat(lPaths.ssh_config),
+        tuple(sorted(cached[1].items())) if cached is not None else None,
+    )
+
+
+def render_menus():
+    """
+    Writes noc_menu and first page of ssh_menu for every split direction to local/menus/ as tmux command
+    files. Key binding shows them with source-file, so menu doesn't need Python at all. @noc_menus global
+    option tells key binding, that menus are rendered. Menus are rendered by daemon, which has parsed
+    ssh config in memory.
+    """
+    for split_direction in MENU_SPLIT_DIRECTIONS:
+        menus = {
+            'noc_menu': noc_menu_command(split_direction, PRERENDERED_MENU_MIN_WIDTH, prerendered=True),
+            'ssh_menu': ssh_menu_command(split_direction, None, 0, PRERENDERED_MENU_MIN_WIDTH),
+        }
+        for menu, command in menus.items():
+            write_file_atomic(menu_file(menu, split_direction),
+                              ' '.join(tmux_quote(argument) for argument in command) + '\n', fsync=False)
+    tmux('set-option', '-g', '@noc_menus', '1')
+
+
+def update_menus():
+    """
+    Renders menus again, if anything they are rendered from has changed. Pre-rendered menus are only
+    a shortcut, so if they can't be rendered, key binding will run noc_menu as before.
+    """
+    try:
+        inputs = menus_inputs()
+        if inputs != menus_state['inputs']:
+            render_menus()
+            menus_state['inputs'] = inputs
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        pass
+
+
+def invalidate_menus():
+    """
+    Makes key binding run noc_menu instead of showing pre-rendered menus, until daemon renders them again.
+    It's done when daemon exits, and when menu inputs are changed not by daemon, e.g. connection is saved
+    by tmux_noc.py itself, so menu doesn't miss new recent hosts.
+    """
+    if os.path.isdir(lPaths.menus):
+        try:
+            tmux('set-option', '-gu', '@noc_menus')
+        except (OSError, subprocess.CalledProcessError):
+            pass
+
+
+def setup_connection(connection_type, split_direction):
+    """
+    Showing connection prompt.
+    """
+    sessions_metadata = load_sessions_metadata()
+    if f'last_{connection_type}_session' in sessions_metadata:
+        hostname = sessions_metadata[f'last_{connection_type}_session']
+    else:
+        hostname = ''
+    command = [
+        'command-prompt',
+        '-p',
+        f'{connection_type}:',
+        '-I',
+        hostname,
+        (f'run "{lPaths.client} connect_{connection_type} --host \'%1\' '
+         f'--split_direction {split_direction}"'),
+    ]
+    tmux(*command)
+
+
+def open_connection_pane(split_direction, shell_command, detached=False, pane_id=None, setup=None):
+    """
+    Opens pane for connection and returns it's id. With detached new window or pane is not made active.
+    Reopen replaces pane_id, or the current pane, if it's not given. setup(target) returns commands for
+    the new pane, they are sent in the same batch, that opens it, so pipe-pane gets all output of the pane.
+    New pane is targeted without it's id: not detached pane is the current pane, detached window is opened
+    as the last window and detached pane is the next one after the current pane.
+    """
+    command = get_split_command(split_direction)
+    if split_direction == 'reopen':
+        if pane_id is None:
+            pane_id = tmux('display-message', '-p', '#{pane_id}').strip()
+        target = ['-t', pane_id]
+        # Pane may be kept with remain-on-exit until it's respawned, see find_host.
+        tmux_batch([
+            [*command, *target, shell_command],
+            ['set', '-p', '-u', *target, 'remain-on-exit'],
+            *(setup(target) if setup else []),
+        ])
+        return pane_id
+    if not detached:
+        target = []
+    elif split_direction == 'new':
+        command += ['-d', '-a', '-t', ':{end}']
+        target = ['-t', ':{end}']
+    else:
+        command.append('-d')
+        target = ['-t', '{next}']
+    commands = [[*command, '-P', '-F', '#{pane_id}', shell_command]]
+    if setup:
+        commands += setup(target)
+    return ''.join(tmux_batch_output(commands)).strip()
+
+
+# Host file of ssh master, that didn't start in this many seconds, is removed.
+SSH_MASTER_START_TIMEOUT = 60
+SSH_CONTROL_NAME_RE = re.compile(r'^[0-9a-f]{16}$')
+
+
+def ssh_control_path(host):
+    """
+    Returns ControlPath of ssh master for the host. Path is made from the host as it's given to ssh,
+    with options, and it's short, so it fits in the unix socket path limit.
+    """
+    return f'{lPaths.ssh_control}/{hashlib.sha1(host.encode()).hexdigest()[:16]}'
+
+
+def unix_socket_connections():
+    """
+    Returns {path: number of sockets} for bound unix sockets from /proc/net/unix: listening socket and
+    every connection accepted by it. None if /proc is not there.
+    """
+    try:
+        with open('/proc/net/unix', 'r') as f:
+            lines = f.readlines()[1:]
+    except OSError:
+        return None
+    sockets = {}
+    for line in lines:
+        fields = line.split(None, 7)
+        if len(fields) == 8:
+            path = fields[7].strip()
+            sockets[path] = sockets.get(path, 0) + 1
+    return sockets
+
+
+def ssh_masters():
+    """
+    Returns ssh masters, that are running or starting, the oldest first: [{path, host, started, sessions}].
+    sessions is number of ssh sessions using the master, None if master is starting or it's not known.
+    Files of closed masters are removed.
+    """
+    if not os.path.isdir(lPaths.ssh_control):
+        return []
+    sockets = unix_socket_connections()
+    now = time.time()
+    masters = []
+    for name in os.listdir(lPaths.ssh_control):
+        if not name.endswith('.host') or not SSH_CONTROL_NAME_RE.match(name[:-5]):
+            continue
+        path = f'{lPaths.ssh_control}/{name[:-5]}'
+        try:
+            with open(f'{path}.host', 'r') as f:
+                host = f.read().strip()
+            host_started = os.path.getmtime(f'{path}.host')
+        except OSError:
+            continue
+        master = {'path': path, 'host': host, 'started': host_started, 'sessions': None}
+        if os.path.exists(path):
+            master['started'] = os.path.getmtime(path)
+            if sockets is not None:
+                # Listening socket and one accepted connection for every session.
+                master['sessions'] = sockets.get(path, 0) - 1
+        if master['sessions'] == -1 or (master['sessions'] is None and not os.path.exists(path)
+                                         and now - host_started > SSH_MASTER_START_TIMEOUT):
+            for filename in (path, f'{path}.host'):
+                if os.path.exists(filename):
+                    os.remove(filename)
+            continue
+        masters.append(master)
+    return sorted(masters, key=lambda master: master['started'])
+
+
+def close_ssh_master(path):
+    """
+    Asks ssh master to exit. Sessions, that use it, are closed too. Files are removed even if master
+    doesn't reply, so new connections don't use it.
+    """
+    try:
+        subprocess.run(['ssh', '-O', 'exit', '-o', f'ControlPath={path}', 'tmuxnoc'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=3)
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+    for filename in (path, f'{path}.host'):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def ssh_multiplexing_options(host, settings):
+    """
+    Returns ssh options, that make connection use ssh master of the host, and start it, if it's not running.
+    If there are ssh_max_masters already, idle masters are closed, the oldest first. If all of them have
+    sessions, connection doesn't use master.
+    """
+    path = ssh_control_path(host)
+    masters = ssh_masters()
+    if all(master['path'] != path for master in masters):
+        excess = len(masters) + 1 - max(settings['ssh_max_masters'], 0)
+        for master in masters:
+            if excess <= 0:
+                break
+            if master['sessions'] == 0:
+                close_ssh_master(master['path'])
+                excess -= 1
+        if excess > 0:
+            return ''
+        create_dir(f'{path}.host')
+        with open(f'{path}.host', 'w') as f:
+            f.write(host + '\n')
+    return (f'-o ControlMaster=auto -o ControlPath={path} '
+            f'-o ControlPersist={settings["ssh_control_persist"]} ')
+
+
+def ssh_pool(prune=False):
+    """
+    Prints ssh masters with their age and number of sessions. With prune, idle masters are closed.
+    """
+    masters = ssh_masters()
+    if prune:
+        for master in masters:
+            if master['sessions'] == 0:
+                close_ssh_master(master['path'])
+        masters = ssh_masters()
+    if not masters:
+        print('No ssh masters.')
+        return
+    now = time.time()
+    print(f'{"host":<40}{"age":>10}{"sessions":>10}')
+    for master in masters:
+        age = datetime.timedelta(seconds=int(now - master['started']))
+        sessions = 'starting' if master['sessions'] is None else master['sessions']
+        print(f'{master["host"][:39]:<40}{str(age):>10}{sessions:>10}')
+
+
+def connection_shell_command(connection_type, host):
+    """
+    Shell command for the connection pane. Connection is started again, when Enter is pressed after it's closed.
+    """
+    home = lPaths.home
+    if connection_type == 'telnet':
+        return (f'PROMPT_COMMAND="{home}/tmuxNOC/scripts/kbdfix.sh telnet {host}" TERM=vt100-w bash \
+              --rcfile {home}/tmuxNOC/misc/tmux_noc_bashrc')
+    settings = load_settings()
+    options = ssh_multiplexing_options(host, settings) if settings['ssh_multiplexing'] else ''
+    return f'PROMPT_COMMAND="ssh {options}{host}" bash --rcfile {home}/tmuxNOC/misc/tmux_noc_bashrc'
+
+
+def connect_telnet(host, split_direction, detached=False, pane_id=None):
+    """
+    Opens telnet connection. Returns pane id.
+    """
+    session_index = save_session('telnet', host)
+    pane_id = open_connection_pane(split_direction, connection_shell_command('telnet', host), detached, pane_id,
+                                   lambda target: connection_log_commands('telnet', host, session_index, target))
+    rename_window(pane_id)
+    return pane_id
+
+
+def connect_ssh(host, split_direction, detached=False, pane_id=None):
+    """
+    Opens SSH connection. Returns pane id.
+    """
+    session_index = save_session('ssh', host)
+    pane_id = open_connection_pane(split_direction, connection_shell_command('ssh', host), detached, pane_id,
+                                   lambda target: connection_log_commands('ssh', host, session_index, target))
+    rename_window(pane_id)
+    return pane_id
+
+
+def bulk_connect(hosts_spec):
+    """
+    Opens connections to many hosts (see resolve_hosts) in new windows, bulk_panes_per_window panes in each,
+    with tiled layout. tmux commands are sent in batches: windows, panes, then names and logs of all panes.
+    Sessions are saved and logs are indexed once for all hosts.
+    """
+    try:
+        hosts = resolve_hosts(hosts_spec)
+    except ValueError as exc:
+        tmux_dm(str(exc))
+        return []
+    if not hosts:
+        tmux_dm(f'No hosts found for {hosts_spec}.')
+        return []
+    panes_per_window = max(load_settings()['bulk_panes_per_window'], 1)
+    windows_hosts = [hosts[index:index + panes_per_window] for index in range(0, len(hosts), panes_per_window)]
+
+    window_ids = ''.join(tmux_batch_output([
+        ['new-window', '-d', '-P', '-F', '#{window_id} #{pane_id}', connection_shell_command(*window_hosts[0])]
+        for window_hosts in windows_hosts
+    ])).split('\n')[:-1]
+    split_commands = []
+    pane_ids = []
+    for window, window_hosts in zip(window_ids, windows_hosts):
+        window_id, pane_id = window.split(' ')
+        pane_ids.append(pane_id)
+        # New pane is put right after the first pane, so panes are opened in reverse order to keep hosts order.
+        for host in reversed(window_hosts[1:]):
+            # Layout is tiled after every split, so there is space for the next pane.
+            split_commands += [
+                ['split-window', '-d', '-t', window_id, '-P', '-F', '#{pane_id}', connection_shell_command(*host)],
+                ['select-layout', '-t', window_id, 'tiled'],
+            ]
+    split_pane_ids = ''.join(tmux_batch_output(split_commands)).split('\n')[:-1]
+    # Panes are ordered the same way as hosts: first pane of window, then it's splits.
+    ordered_pane_ids = []
+    for window_number, window_hosts in enumerate(windows_hosts):
+        ordered_pane_ids.append(pane_ids[window_number])
+        ordered_pane_ids += reversed(split_pane_ids[:len(window_hosts) - 1])
+        split_pane_ids = split_pane_ids[len(window_hosts) - 1:]
+
+    session_indexes = save_sessions(hosts)
+    log_filenames = []
+    setup_commands = []
+    for (connection_type, host), pane_id, session_index in zip(hosts, ordered_pane_ids, session_indexes):
+        short_type = connection_type[0]
+        log_filename = pane_log_filename(short_type, host, session_index)
+        log_filenames.append(log_filename)
+        setup_commands += [
+            ['set', '-p', '-t', pane_id, '@pane_name', f'{short_type}/{host}'],
+            ['set', '-p', '-t', pane_id, '@noc_log', log_filename],
+            pipe_pane_command(log_filename, ['-t', pane_id]),
+        ]
+    add_logs_to_index(log_filenames)
+    tmux_batch(setup_commands)
+    panes_list = tmux('list-panes', '-a', '-F', RENAME_WINDOWS_FORMAT).split('\n')[:-1]
+    tmux_batch(rename_windows_commands(panes_list))
+    return ordered_pane_ids
+
+
+# Everything snapshot needs about every pane, pane name is the last, because it may have tabs.
+SNAPSHOT_FORMAT = '\t'.join([
+    '#{pid}', '#{window_id}', '#{window_name}', '#{@window_title}', '#{automatic-rename}', '#{window_layout}',
+    '#{pane_active}', '#{pane_pipe}', '#{@noc_log}', '#{pane_current_path}', '#{@pane_name}',
+])
+# Name of the snapshot, that daemon saves for tmux server with this pid.
+SNAPSHOT_AUTO_NAME = 'auto-{}'
+# This many automatic snapshots of the last tmux servers are kept.
+SNAPSHOT_AUTO_KEEP = 5
+SNAPSHOT_NAME_RE = re.compile(r'^[\w.-]+$')
+# tmux 3.3 crashes on select-layout with some malformed layouts, so layout from the file is checked first.
+WINDOW_LAYOUT_RE = re.compile(r'^[0-9a-f]{4},\d+x\d+,\d+,\d+[,{\[]')
+# Pane name of connection: s/host or t/host.
+CONNECTION_PANE_NAME_RE = re.compile(r'^([st])/(.+)$')
+
+
+def snapshot_file(name):
+    return f'{lPaths.snapshots}/{name}.json'
+
+
+def take_snapshot():
+    """
+    Returns snapshot of all windows of tmux server, made with one list-panes command: window title, automatic
+    rename and layout, and for every pane its name, connection, log file and directory. Window name is saved only
+    for windows with title, other names are made by rename_windows from pane names. Windows are in list-panes order.
+    """
+    workspace = {'created': time.time(), 'server': None, 'windows': []}
+    windows = {}
+    for line in tmux('list-panes', '-a', '-F', SNAPSHOT_FORMAT).split('\n')[:-1]:
+        (server, window_id, window_name, window_title, automatic_rename, layout, active, pipe, log_file, path,
+         pane_name) = line.split('\t', 10)
+        workspace['server'] = server
+        if window_id not in windows:
+            windows[window_id] = {
+                'title': window_title,
+                'automatic_rename': automatic_rename == '1',
+                'layout': layout,
+                'panes': [],
+            }
+            if window_title:
+                windows[window_id]['name'] = window_name
+            workspace['windows'].append(windows[window_id])
+        pane = {'name': pane_name, 'active': active == '1', 'path': path, 'logged': pipe == '1', 'log': log_file}
+        match = CONNECTION_PANE_NAME_RE.match(pane_name)
+        if match:
+            pane['connection_type'] = {'s': 'ssh', 't': 'telnet'}[match.group(1)]
+            pane['host'] = match.group(2)
+        windows[window_id]['panes'].append(pane)
+    return workspace
+
+
+def list_snapshots():
+    """
+    Returns [(name, snapshot)] of saved snapshots, the newest first.
+    """
+    snapshots = []
+    for filename in glob.glob(snapshot_file('*')):
+        try:
+            with open(filename, 'r') as f:
+                snapshots.append((os.path.basename(filename)[:-len('.json')], json.load(f)))
+        except (OSError, ValueError):
+            continue
+    return sorted(snapshots, key=lambda entry: entry[1].get('created', 0), reverse=True)
+
 
-        'Move Pane to Window - Horizontal', 'M',
-        f'run "{script_path} move_pane_window --split_direction horizontal"',
-        '',
-        # -----
-        'Show Sessions History', 'h',
-        (f'{split_command} "less +G $HOME/tmuxNOC/local/sessions_history.log"; '
-         f'set -p @pane_name "Sessions History"; run "{script_path} rename_window"'),
+def save_snapshot(name=None):
+    """
+    Saves snapshot of all windows to local/snapshots/{name}.json. Without name it's automatic snapshot of
+    the current tmux server, only the last SNAPSHOT_AUTO_KEEP servers have them.
+    """
+    if name is not None and not SNAPSHOT_NAME_RE.match(name):
+        raise ValueError(f'Snapshot name can have only letters, digits, ".", "-" and "_": {name}')
+    workspace = take_snapshot()
+    if not workspace['windows']:
+        return workspace
+    create_dir(f'{lPaths.snapshots}/')
+    write_file_atomic(snapshot_file(name or SNAPSHOT_AUTO_NAME.format(workspace['server'])),
+                      json.dumps(workspace), fsync=False)
+    if name is None:
+        auto_snapshots = [auto_name for auto_name, _ in list_snapshots()
+                          if auto_name.startswith(SNAPSHOT_AUTO_NAME.format(''))]
+        for auto_name in auto_snapshots[SNAPSHOT_AUTO_KEEP:]:
+            os.remove(snapshot_file(auto_name))
+    return workspace
 
-        'Open Log File', 'l',
-        (f'command-prompt -p "Open Log Number:" \'run "{script_path} open_log '
-         f'--history_index %1 --split_direction {split_direction}"\''),
 
-        'Search in Logs', 'L',
-        f'{split_command} "{script_path} search_logs"; set -p @pane_name "grep in logs"',
-        # -----
-    ]
-    if split_direction == 'new':
-        command += [
-            '',
-            'Send Commands with Delay', 'd',
-            (f'split-window -h "{script_path} send_with_delay '
-             f'--pane_id $(tmux display -pt - \'#{{pane_id}}\')"'),
-        ]
-    command += [
-        # -----
-        '',
-        'Connect from Clipboard', 'v',
-        f'run "{script_path} clipboard_menu --split_direction {split_direction}"',
+def update_snapshot():
+    """
+    Saves automatic snapshot for daemon. Failed snapshot is just skipped, the previous one is kept.
+    """
+    try:
+        save_snapshot()
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        pass
 
-        'New Telnet', 'q',
-        (f'run "{script_path} setup_connection --connection_type telnet '
-         f'--split_direction {split_direction}"'),
 
-        'New SSH', 's',
-        (f'run "{script_path} setup_connection --connection_type ssh '
-         f'--split_direction {split_direction}"'),
-    ]
-    if ssh_config_hosts_exists:
-        command += [
-            'SSH Config Hosts', 'S',
-            f'run "{script_path} ssh_menu --split_direction {split_direction}"',
-        ]
-    if last_sessions_menu_block is not None:
-        command += last_sessions_menu_block
-    subprocess.run(command, check=True)
+def snapshot(name=None):
+    """
+    Saves snapshot with the given name (manual by default) and shows what is in it.
+    """
+    name = name or 'manual'
+    workspace = save_snapshot(name)
+    connections = sum('host' in pane for window in workspace['windows'] for pane in window['panes'])
+    tmux_dm(f'{len(workspace["windows"])} windows, {connections} connections are saved to snapshot "{name}".')
 
 
-def setup_connection(connection_type, split_direction):
+def restore_snapshot(name=None):
     """
-    Showing connection prompt.
+    Opens windows and panes of the snapshot in the current session, with the same layouts, titles, pane names
+    and connections. Without name the newest snapshot of other tmux server is used, that is the one before
+    tmux server was restarted. Windows are opened with one batch and panes with another, so all
+    connections are started at once. Pane, that had log, appends to the same log file, if it's still
+    there and not compressed, otherwise connection gets new session and new log.
     """
-    sessions_metadata = load_sessions_metadata()
-    if f'last_{connection_type}_session' in sessions_metadata:
-        hostname = sessions_metadata[f'last_{connection_type}_session']
+    snapshots = list_snapshots()
+    if name is None:
+        server = tmux('display-message', '-p', '#{pid}').strip()
+        found = [saved for _, saved in snapshots if saved.get('server') != server]
     else:
-        hostname = ''
-    command = [
-        'tmux',
-        'command-prompt',
-        '-p',
-        f'{connection_type}:',
-        '-I',
-        hostname,
-        (f'run "{lPaths.script} connect_{connection_type} --host \'%1\' '
-         f'--split_direction {split_direction}"'),
-    ]
-    subprocess.run(command, check=True)
+        found = [saved for saved_name, saved in snapshots if saved_name == name]
+    if not found:
+        names = ', '.join(saved_name for saved_name, _ in snapshots) or 'none'
+        tmux_dm(f'No snapshot to restore. Saved snapshots: {names}')
+        return []
+    windows = found[0]['windows']
 
+    def pane_command(pane):
+        command = []
+        if os.path.isdir(pane['path']):
+            command += ['-c', pane['path']]
+        if 'host' in pane:
+            command.append(connection_shell_command(pane['connection_type'], pane['host']))
+        return command
 
-def connect_telnet(host, split_direction):
-    home = lPaths.home
-    subprocess.run(
-        get_split_command(split_direction) + [
-            f'PROMPT_COMMAND="{home}/tmuxNOC/scripts/kbdfix.sh telnet {host}" TERM=vt100-w bash \
-              --rcfile {home}/tmuxNOC/misc/tmux_noc_bashrc'
-        ],
-        check=True
-    )
-    tmux_set_pane_name(f't/{host}')
-    rename_window()
-    save_session('telnet', host)
-    if split_direction == 'reopen':
-        pane_log('t', host, restart=True)
-    else:
-        pane_log('t', host)
+    window_ids = ''.join(tmux_batch_output([
+        ['new-window', '-d', '-P', '-F', '#{window_id} #{pane_id}', *pane_command(window['panes'][0])]
+        for window in windows
+    ])).split('\n')[:-1]
+    split_commands = []
+    pane_ids = []
+    for window_line, window in zip(window_ids, windows):
+        window_id, pane_id = window_line.split(' ')
+        window['id'] = window_id
+        pane_ids.append(pane_id)
+        # Same as in bulk_connect: reverse order keeps panes order, tiled layout leaves space for the next pane.
+        for pane in reversed(window['panes'][1:]):
+            split_commands += [
+                ['split-window', '-d', '-t', window_id, '-P', '-F', '#{pane_id}', *pane_command(pane)],
+                ['select-layout', '-t', window_id, 'tiled'],
+            ]
+    split_pane_ids = ''.join(tmux_batch_output(split_commands)).split('\n')[:-1]
+    panes = []
+    for window_number, window in enumerate(windows):
+        window_pane_ids = [pane_ids[window_number]] + list(reversed(split_pane_ids[:len(window['panes']) - 1]))
+        split_pane_ids = split_pane_ids[len(window['panes']) - 1:]
+        panes += zip(window_pane_ids, window['panes'])
 
+    new_sessions = [(pane['connection_type'], pane['host']) for _, pane in panes
+                    if 'host' in pane and pane['logged'] and not os.path.isfile(pane['log'])]
+    session_indexes = iter(save_sessions(new_sessions) if new_sessions else [])
+    new_logs = []
+    commands = []
+    for pane_id, pane in panes:
+        if pane['name']:
+            commands.append(['set', '-p', '-t', pane_id, '@pane_name', pane['name']])
+        log_filename = pane['log'] if pane['logged'] else ''
+        if pane['logged'] and not os.path.isfile(log_filename) and 'host' in pane:
+            short_type = CONNECTION_TYPES[pane['connection_type']]
+            log_filename = pane_log_filename(short_type, pane['host'], next(session_indexes))
+            new_logs.append(log_filename)
+        if os.path.isfile(log_filename) or log_filename in new_logs:
+            commands += [
+                ['set', '-p', '-t', pane_id, '@noc_log', log_filename],
+                pipe_pane_command(log_filename, ['-t', pane_id]),
+            ]
+        if pane['active']:
+            commands.append(['select-pane', '-t', pane_id])
+    for window in windows:
+        if WINDOW_LAYOUT_RE.match(window['layout']):
+            commands.append(['select-layout', '-t', window['id'], window['layout']])
+        if window['title']:
+            commands += [
+                ['set', '-w', '-t', window['id'], '@window_title', window['title']],
+                ['rename-window', '-t', window['id'], window.get('name') or window['title']],
+            ]
+        else:
+            commands.append(['set', '-w', '-t', window['id'], 'automatic-rename',
+                             'on' if window['automatic_rename'] else 'off'])
+    add_logs_to_index(new_logs)
+    tmux_batch(commands)
+    # Names of windows without title are made from pane names, the same way as for other windows.
+    panes_list = tmux('list-panes', '-a', '-F', RENAME_WINDOWS_FORMAT).split('\n')[:-1]
+    tmux_batch(rename_windows_commands(panes_list))
+    return [pane_id for pane_id, _ in panes]
 
-def connect_ssh(host, split_direction):
-    home = lPaths.home
-    subprocess.run(
-        get_split_command(split_direction) + [
-            f'PROMPT_COMMAND="ssh {host}" bash --rcfile {home}/tmuxNOC/misc/tmux_noc_bashrc'
-        ],
-        check=True
-    )
-    tmux_set_pane_name(f's/{host}')
-    rename_window()
-    save_session('ssh', host)
-    if split_direction == 'reopen':
-        pane_log('s', host, restart=True)
-    else:
-        pane_log('s', host)
+
+# Separator is tab, because it's unlikely to be in window or pane name.
+RENAME_WINDOWS_FORMAT = '#{window_id}\t#{@window_title}\t#{automatic-rename}\t#{window_name}\t#{@pane_name}'
+
+
+def rename_windows_commands(panes_list):
+    """
+    Returns tmux commands for renaming windows, made from list-panes output with RENAME_WINDOWS_FORMAT.
+    Window name is made from pane names. If no pane has a name, automatic rename is turned on.
+    Commands are returned only for windows that need to be changed.
+    """
+    windows = {}
+    for pane in panes_list:
+        window_id, window_title, automatic_rename, window_name, pane_name = pane.split('\t', 4)
+        window = windows.setdefault(window_id, {
+            'title': window_title,
+            'automatic_rename': automatic_rename == '1',
+            'name': window_name,
+            'rename': False,
+            'panes': [],
+        })
+        if pane_name == '':
+            window['panes'].append('local')
+        else:
+            window['rename'] = True
+            window['panes'].append(pane_name)
+
+    commands = []
+    for window_id, window in windows.items():
+        if window['title']:
+            continue
+        if window['rename']:
+            new_name = '\u2503'.join(window['panes'])
+            if new_name != window['name'] or window['automatic_rename']:
+                commands.append(['rename-window', '-t', window_id, new_name])
+        elif not window['automatic_rename']:
+            commands.append(['set', '-w', '-t', window_id, 'automatic-rename', 'on'])
+    return commands
 
 
 def rename_window(window_id=':'):
@@ -549,99 +3289,295 @@ def rename_window(window_id=':'):
     if window_id is None:
         window_id = ':'
 
-    window_title = subprocess.check_output(['tmux', 'show', '-t', window_id, '-w', '@window_title'], encoding='UTF-8')
-    if window_title:
-        return 0
-
-    panes_list = subprocess.check_output(
-        ['tmux', 'list-panes', '-t', window_id, '-F', '#{@pane_name}'],
-        encoding='UTF-8'
-    ).split('\n')[:-1]
-    rename = False
-    window_name = []
-    for pane_name in panes_list:
-        if pane_name == '':
-            window_name.append('local')
-        else:
-            rename = True
-            window_name.append(pane_name)
-    if rename:
-        subprocess.run(['tmux', 'rename-window', '-t', window_id, '\u2503'.join(window_name)], check=True)
-    else:
-        subprocess.run(['tmux', 'set', '-w', '-t', window_id, 'automatic-rename', 'on'], check=True)
+    panes_list = tmux('list-panes', '-t', window_id, '-F', RENAME_WINDOWS_FORMAT).split('\n')[:-1]
+    tmux_batch(rename_windows_commands(panes_list))
 
 
 def rename_windows():
     """
-    Rename all windows.
+    Rename all windows. All panes are listed with one command and all renames are sent at once.
     """
-    windows_list = subprocess.check_output(
-        ['tmux', 'list-windows', '-F', '#{window_id}'],
-        encoding='UTF-8'
-    ).split('\n')[:-1]
-
-    for window_id in windows_list:
-        rename_window(window_id)
+    panes_list = tmux('list-panes', '-a', '-F', RENAME_WINDOWS_FORMAT).split('\n')[:-1]
+    tmux_batch(rename_windows_commands(panes_list))
 
 
 def tmux_send(string, conformation_symbol='Enter', target_pane=':'):
     """
     Send string to the pane.
     """
-    subprocess.run(
-        ['tmux', 'send-keys', '-t', target_pane, string, f'{conformation_symbol}'],
-        check=True
-    )
+    tmux('send-keys', '-t', target_pane, string, f'{conformation_symbol}')
+
+
+# Password prompt of the device, it's matched in the output after login is sent. Prompts end with \Z, not $,
+# because $ matches before the last new line too, and output line would be taken for a prompt.
+LOGIN_PROMPT = r'(?:user ?name|login)[^\n]*:[ \t]*\Z'
+PASSWORD_PROMPT = r'pass(?:word|code|phrase)[^\n]*:[ \t]*\Z'
+# Login profiles: {state: [rule]}. Rule is sent when it's prompt shows up. Response is sent with Enter,
+# {login}, {password} and {enable} are replaced with credentials. Rule with "needs" is used only if
+# that credential is given. Login ends in "done" or "failed" state, nothing is sent then.
+# Prompts are matched case insensitive.
+LOGIN_PROFILES = {
+    # Network devices: Username/Password, then enable, if enable password is given.
+    'default': {
+        'start': [
+            {'prompt': LOGIN_PROMPT, 'send': '{login}', 'next': 'login'},
+            {'prompt': PASSWORD_PROMPT, 'send': '{password}', 'next': 'password'},
+        ],
+        'login': [
+            {'prompt': PASSWORD_PROMPT, 'send': '{password}', 'next': 'password'},
+        ],
+        'password': [
+            {'prompt': f'{LOGIN_PROMPT}|{PASSWORD_PROMPT}', 'next': 'failed'},
+            {'prompt': r'>[ \t]*\Z', 'send': 'enable', 'next': 'enable', 'needs': 'enable'},
+            {'prompt': r'[>#$%\]][ \t]*\Z', 'next': 'done'},
+        ],
+        'enable': [
+            {'prompt': PASSWORD_PROMPT, 'send': '{enable}', 'next': 'enable_password'},
+            {'prompt': r'#[ \t]*\Z', 'next': 'done'},
+        ],
+        'enable_password': [
+            {'prompt': r'#[ \t]*\Z', 'next': 'done'},
+            {'prompt': rf'{PASSWORD_PROMPT}|>[ \t]*\Z', 'next': 'failed'},
+        ],
+    },
+    # Unix hosts: login/Password, then shell prompt.
+    'linux': {
+        'start': [
+            {'prompt': LOGIN_PROMPT, 'send': '{login}', 'next': 'login'},
+            {'prompt': PASSWORD_PROMPT, 'send': '{password}', 'next': 'password'},
+        ],
+        'login': [
+            {'prompt': PASSWORD_PROMPT, 'send': '{password}', 'next': 'password'},
+        ],
+        'password': [
+            {'prompt': f'{LOGIN_PROMPT}|{PASSWORD_PROMPT}', 'next': 'failed'},
+            {'prompt': r'[$#%>][ \t]*\Z', 'next': 'done'},
+        ],
+    },
+}
+# Rules for every state: pagers of banners are scrolled with space.
+LOGIN_COMMON_RULES = [
+    {'prompt': r'(?:-+ ?\(?more\b[^\n]*|press any key to continue[^\n]*)\Z', 'send': ' ', 'enter': False},
+]
+LOGIN_KEY_RE = re.compile(r'(LOGIN|PASS|ENABLE|PROFILE)(\d+)=(.*)$')
+LOGIN_KEYS = {'LOGIN': 'login', 'PASS': 'password', 'ENABLE': 'enable', 'PROFILE': 'profile'}
+# Compiled login states {(profile, state, credentials that are given): (pattern, rules)}.
+login_patterns = {}
 
 
-def tmux_wait_for(string, timeout=3):
+def parse_logins(f):
     """
-    Wait for the string to show up in terminal. Returns true if string in the last 2 lines on the
-    screen, else false.
+    Parses .logins file: LOGIN1=, PASS1=, optional ENABLE1= and PROFILE1= lines.
+    Returns {login number: {'login', 'password', 'enable', 'profile'}}.
     """
-    found = False
-    for _ in range(timeout*10):
-        screen_content_list = subprocess.check_output(
-            ['tmux', 'capture-pane', '-J', '-p'],
-            encoding='UTF-8'
-        ).split('\n')
-        screen_content_list_filtered = [line for line in screen_content_list if len(line) != 0]
-        for line in screen_content_list_filtered[-2:]:
-            if string in line:
-                found = True
-                break
-        if found:
-            break
+    logins = {}
+    for line in f:
+        match = LOGIN_KEY_RE.match(line.rstrip('\r\n'))
+        if match is not None:
+            key, login_number, value = match.groups()
+            logins.setdefault(login_number, {})[LOGIN_KEYS[key]] = value
+    return logins
+
+
+def login_pattern(profile, state, credentials):
+    """
+    Returns (pattern, rules) for login state: one regular expression with a group for every rule, so all
+    rules are matched at once.
+    """
+    given = tuple(sorted(name for name, value in credentials.items() if value))
+    key = (profile, state, given)
+    if key not in login_patterns:
+        rules = [
+            rule for rule in LOGIN_PROFILES[profile][state] + LOGIN_COMMON_RULES
+            if 'needs' not in rule or rule['needs'] in given
+        ]
+        pattern = re.compile('|'.join(f'(?P<rule{index}>{rule["prompt"]})' for index, rule in enumerate(rules)),
+                             re.IGNORECASE)
+        login_patterns[key] = (pattern, rules)
+    return login_patterns[key]
+
+
+def login_rule(rule, credentials, pane_id):
+    """
+    Sends response of the rule.
+    """
+    if 'send' in rule:
+        response = rule['send'].format(**credentials)
+        if rule.get('enter', True):
+            tmux_send(response, target_pane=pane_id)
         else:
-            time.sleep(0.1)
+            tmux('send-keys', '-t', pane_id, '-l', response)
 
-    return found
 
+def run_login(pane_id, credentials, timeout):
+    """
+    Logs in to the device in the pane by it's login profile. Every rule is answered as soon as it's prompt
+    shows up in the output. If there is no login or password prompt on the screen, login is sent right away.
+    Returns None, if login is done, otherwise the reason why not.
+    """
+    profile = credentials.get('profile') or 'default'
+    if profile not in LOGIN_PROFILES:
+        return f'unknown login profile {profile}'
+    state = 'start'
+    with watch_pane_output(pane_id) as output:
+        pattern, rules = login_pattern(profile, state, credentials)
+        screen = [line for line in tmux('capture-pane', '-J', '-p', '-t', pane_id).split('\n') if line]
+        match = pattern.search(screen[-1]) if screen else None
+        if match is None:
+            tmux_send(credentials['login'], target_pane=pane_id)
+            state = 'login'
+        while True:
+            if match is not None:
+                rule = rules[int(match.lastgroup[4:])]
+                login_rule(rule, credentials, pane_id)
+                state = rule.get('next', state)
+                if state == 'done':
+                    return None
+                if state == 'failed':
+                    return f'login failed: {match.group(0).strip()}'
+            pattern, rules = login_pattern(profile, state, credentials)
+            match = output.wait_for_match(pattern, timeout)
+            if match is None:
+                return f'no prompt in {state} state'
 
-def send_login_pwd(login_number):
+
+def send_login_pwd(login_number, pane_id=None):
     """
     Send login/password sequence.
     """
-    login, password = '', ''
-
     if not os.path.exists(lPaths.logins):
         tmux_dm(f'File {lPaths.logins} doesn\'t exists.')
         return
-    with open(lPaths.logins, 'r') as f:
-        logins = f.readlines()
-    for line in logins:
-        if f'LOGIN{login_number}' in line:
-            login = line.replace(f'LOGIN{login_number}=', '').replace('\n', '')
-        if f'PASS{login_number}' in line:
-            password = line.replace(f'PASS{login_number}=', '').replace('\n', '')
-    if not login or not password:
+    credentials = read_cached(lPaths.logins, parse_logins).get(str(login_number), {})
+    if not credentials.get('login') or not credentials.get('password'):
         tmux_dm(f'Login-password pair {login_number} not found in {lPaths.logins}.')
         return
-    tmux_send(login)
-    if tmux_wait_for('assword'):
-        tmux_send(password)
-    else:
-        tmux_dm('Password prompt not found.')
+    credentials = dict({'enable': '', 'profile': ''}, **credentials)
+    if pane_id is None:
+        pane_id = tmux('display-message', '-p', '#{pane_id}').strip()
+    error = run_login(pane_id, credentials, load_settings()['prompt_timeout'])
+    if error is not None:
+        tmux_dm(f'Login {login_number}: {error}.')
+
+
+# Device prompt, that is waited for between lines, if no other prompt is given. It's searched in the output
+# with new lines, so it ends with \Z: $ matches before the last new line too, e.g. in "[OK]\n".
+DEVICE_PROMPT_RE = r'[>#$%\]][ \t]*\Z'
+
+
+class SendProgress:
+    """
+    Shows lines, that are sent, current line is highlighted. Screen is drawn once, after that only changed
+    lines are redrawn and screen is scrolled by terminal, so progress view doesn't slow down sending.
+    """
+    def __init__(self, lines):
+        self.lines = lines
+        self.columns, rows = shutil.get_terminal_size()
+        self.rows = max(rows - 2, 1)
+        self.offset = 0
+        self.current = None
+        sys.stdout.write('\x1b[H\x1b[2J')
+        for index in range(min(len(lines), self.rows)):
+            self.draw_line(index)
+        sys.stdout.flush()
+
+    def draw_line(self, index, highlight=False):
+        row = index - self.offset + 1
+        if 1 <= row <= self.rows and index < len(self.lines):
+            line = self.lines[index][:self.columns - 1]
+            if highlight:
+                line = f'{ANSIColors.OKGREEN}{ANSIColors.BOLD}{line}{ANSIColors.ENDC}'
+            sys.stdout.write(f'\x1b[{row};1H\x1b[2K{line}')
+
+    def update(self, index, status=''):
+        # Current line is kept 6th from the top, when there are more lines than fit on the screen.
+        offset = min(max(index - 5, 0), max(len(self.lines) - self.rows, 0))
+        if offset != self.offset:
+            shift = offset - self.offset
+            self.offset = offset
+            if shift < self.rows:
+                sys.stdout.write(f'\x1b[1;{self.rows}r\x1b[{shift}S\x1b[r')
+                for row in range(self.rows - shift, self.rows):
+                    self.draw_line(offset + row)
+            else:
+                for row in range(self.rows):
+                    self.draw_line(offset + row)
+        if self.current is not None:
+            self.draw_line(self.current)
+        self.draw_line(index, highlight=True)
+        self.current = index
+        sys.stdout.write(f'\x1b[{self.rows + 2};1H\x1b[2K{ANSIColors.OKBLUE}{index + 1}/{len(self.lines)} '
+                         f'{status}{ANSIColors.ENDC}')
+        sys.stdout.flush()
+
+
+def send_lines(pane_id, lines, line_delay, character_delay=0, prompt=None, prompt_timeout=5, progress=None):
+    """
+    Sends lines to the pane. Delays are in milliseconds. Sends are scheduled on monotonic clock, time spent
+    on sending is taken from the delay, so the delays don't drift. If sending is late, schedule starts from
+    now, so lines are not sent in bursts. If prompt (regular expression) is given, next line is sent when
+    prompt shows up, instead of line delay. Returns number of done lines: line is done, when it's sent and
+    prompt showed up after it. Sending stops, if prompt wasn't found.
+    All commands go through one tmux client, see get_tmux_transport.
+    """
+    with contextlib.ExitStack() as stack:
+        output = stack.enter_context(watch_pane_output(pane_id)) if prompt is not None else None
+        next_send = time.monotonic()
+        for index, line in enumerate(lines):
+            if progress is not None:
+                progress.update(index)
+            if character_delay > 0:
+                for character in line:
+                    time.sleep(max(next_send - time.monotonic(), 0))
+                    tmux('send-keys', '-t', pane_id, '-l', character)
+                    next_send = max(next_send + character_delay / 1000, time.monotonic())
+                time.sleep(max(next_send - time.monotonic(), 0))
+            elif line:
+                tmux('send-keys', '-t', pane_id, '-l', line)
+            tmux('send-keys', '-t', pane_id, 'Enter')
+            if output is not None:
+                if output.wait_for(prompt, prompt_timeout) is None:
+                    if progress is not None:
+                        progress.update(index, f'prompt not found in {prompt_timeout} seconds, stopped.')
+                    return index
+                next_send = time.monotonic()
+            elif index + 1 < len(lines):
+                next_send = max(next_send + line_delay / 1000, time.monotonic())
+                time.sleep(max(next_send - time.monotonic(), 0))
+    return len(lines)
+
+
+def input_delay(message, default, allow_prompt=False):
+    """
+    Asks for delay in milliseconds until valid answer. Returns None, if prompt is chosen instead of delay.
+    """
+    while True:
+        answer = input(f'{ANSIColors.WARNING}{message} [{default}]: {ANSIColors.ENDC}') or default
+        if allow_prompt and str(answer).lower() == 'p':
+            return None
+        try:
+            delay = int(answer)
+        except ValueError:
+            print(f'{ANSIColors.FAIL}Enter an integer.{ANSIColors.ENDC}')
+            continue
+        if delay < 0:
+            print(f'{ANSIColors.FAIL}Enter a positive integer or 0.{ANSIColors.ENDC}')
+            continue
+        return delay
+
+
+def input_prompt_regex():
+    """
+    Asks for regular expression of device prompt, until it's valid.
+    """
+    while True:
+        prompt = input(f'{ANSIColors.WARNING}Prompt regular expression [{DEVICE_PROMPT_RE}]: '
+                       f'{ANSIColors.ENDC}') or DEVICE_PROMPT_RE
+        try:
+            re.compile(prompt)
+            return prompt
+        except re.error as exc:
+            print(f'{ANSIColors.FAIL}Wrong regular expression: {exc}.{ANSIColors.ENDC}')
 
 
 def send_with_delay(pane_id):
@@ -656,61 +3592,438 @@ def send_with_delay(pane_id):
         s = input()
         if s != '.':
             commands.append(s)
-    while True:
-        try:
-            line_delay = input(
-                f'{ANSIColors.WARNING}Enter LINE delay in milliseconds [500]: {ANSIColors.ENDC}'
-            ) or 500
-            line_delay = int(line_delay)
-        except ValueError:
-            print(f'{ANSIColors.FAIL}Enter an integer.{ANSIColors.ENDC}')
-            continue
-        if line_delay < 0:
-            print(f'{ANSIColors.FAIL}Enter a positive integer or 0.{ANSIColors.ENDC}')
-            continue
+    line_delay = input_delay('Enter LINE delay in milliseconds, or p to wait for device prompt', 500, True)
+    prompt = None
+    if line_delay is None:
+        prompt = input_prompt_regex()
+        line_delay = 0
+    character_delay = input_delay('Enter CHARACTER delay in milliseconds', 0)
+
+    progress = SendProgress(commands)
+    send_lines(pane_id, commands, line_delay, character_delay, prompt, load_settings()['prompt_timeout'],
+               progress)
+    sys.stdout.write(f'\x1b[{progress.rows + 2};1H\n')
+
+
+# Prompt of tmux_noc_bashrc, it's shown when connection is closed.
+CONNECTION_CLOSED_PROMPT = 'Hit ENTER to retry.'
+
+
+def resolve_hosts(hosts_spec):
+    """
+    Returns list of unique (connection_type, host) for hosts list:
+    "ssh:pattern" - ssh config hosts, that match the pattern (* and ? wildcards),
+    "recent:N" - N most frecent sessions, anything else is a hosts file (see read_hosts_file).
+    Raises ValueError with the message for user, if N is not a number.
+    """
+    if hosts_spec.startswith('ssh:'):
+        hosts = [('ssh', host) for host in ssh_config_hosts() or [] if fnmatch.fnmatchcase(host, hosts_spec[4:])]
+    elif hosts_spec.startswith('recent:'):
+        if not hosts_spec[7:].isdigit():
+            raise ValueError(f'Number of recent sessions is expected after "recent:": {hosts_spec}')
+        settings = dict(load_settings(), recent_sessions_menu=int(hosts_spec[7:]))
+        hosts = recent_sessions(load_sessions_metadata(), settings)
+    else:
+        hosts = read_hosts_file(os.path.expanduser(hosts_spec))
+    return list(dict.fromkeys(hosts))
+
+
+def wait_for_first_prompt(pane_id, prompt, timeout):
+    """
+    Waits for the device prompt after connection is opened. Returns None if prompt is found, otherwise
+    the reason why not.
+    """
+    pattern = re.compile(f'(?:{prompt})|{re.escape(CONNECTION_CLOSED_PROMPT)}')
+    with watch_pane_output(pane_id) as output:
+        # Prompt could show up before output was watched.
+        screen = [line for line in tmux('capture-pane', '-J', '-p', '-t', pane_id).split('\n') if line]
+        match = pattern.search(screen[-1]) if screen else None
+        matched = match.group(0) if match is not None else output.wait_for(pattern, timeout)
+    if matched is None:
+        return f'no prompt in {timeout} seconds'
+    if matched == CONNECTION_CLOSED_PROMPT:
+        return 'connection closed'
+    return None
+
+
+def run_on_host(connection_type, host, commands, prompt, settings):
+    """
+    Opens connection in a new background window, waits for the prompt and sends commands, every next
+    command is sent after the prompt. Output is written to the session log as usual.
+    Returns (pane_id, number of done commands, error or None).
+    """
+    pane_id = None
+    try:
+        if connection_type == 'telnet':
+            pane_id = connect_telnet(host, 'new', detached=True)
         else:
-            break
-    while True:
-        try:
-            character_delay = input(
-                f'{ANSIColors.WARNING}Enter CHARACTER delay in milliseconds [0]: {ANSIColors.ENDC}'
-            ) or 0
-            character_delay = int(character_delay)
-        except ValueError:
-            print(f'{ANSIColors.FAIL}Enter an integer.{ANSIColors.ENDC}')
-            continue
-        if character_delay < 0:
-            print(f'{ANSIColors.FAIL}Enter a positive integer or 0.{ANSIColors.ENDC}')
-            continue
+            pane_id = connect_ssh(host, 'new', detached=True)
+        error = wait_for_first_prompt(pane_id, prompt, settings['connect_timeout'])
+        if error is not None:
+            return pane_id, 0, error
+        done = send_lines(pane_id, commands, 0, prompt=prompt, prompt_timeout=settings['prompt_timeout'])
+        if done < len(commands):
+            return pane_id, done, f'no prompt after "{commands[done]}"'
+        return pane_id, done, None
+    except subprocess.CalledProcessError as exc:
+        return pane_id, 0, f'tmux error: {str(exc.output).strip()}'
+
+
+async def run_on_hosts_async(hosts, commands, prompt, settings, report):
+    """
+    Runs commands on hosts, not more than run_concurrency hosts at once. Blocking tmux work is done in
+    threads, tmux commands from all of them go through one tmux client.
+    """
+    semaphore = asyncio.Semaphore(settings['run_concurrency'])
+    loop = asyncio.get_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=settings['run_concurrency'])
+
+    async def run_one(connection_type, host):
+        async with semaphore:
+            result = await loop.run_in_executor(
+                executor, run_on_host, connection_type, host, commands, prompt, settings
+            )
+        report(connection_type, host, *result)
+        return (connection_type, host) + result
+
+    try:
+        return await asyncio.gather(*(run_one(connection_type, host) for connection_type, host in hosts))
+    finally:
+        executor.shutdown(wait=False)
+
+
+def run_on_hosts(hosts_spec=None, commands_file=None):
+    """
+    Runs the same commands on many hosts at once. Hosts and commands are asked for, if not given.
+    Ends with the summary of succeeded and failed hosts.
+    """
+    tmux_set_pane_name('Run on hosts')
+    rename_window()
+    settings = load_settings()
+    if hosts_spec is None:
+        hosts_spec = input(f'{ANSIColors.WARNING}Hosts (file, ssh:pattern or recent:N): {ANSIColors.ENDC}')
+    try:
+        hosts = resolve_hosts(hosts_spec.strip())
+    except ValueError as exc:
+        print(f'{ANSIColors.FAIL}{exc}{ANSIColors.ENDC}')
+        return
+    if not hosts:
+        print(f'{ANSIColors.FAIL}No hosts found.{ANSIColors.ENDC}')
+        return
+    print(f'{ANSIColors.OKBLUE}{len(hosts)} hosts: '
+          f'{", ".join(host for _, host in hosts[:10])}{" ..." if len(hosts) > 10 else ""}{ANSIColors.ENDC}')
+    if commands_file is None:
+        print(f'{ANSIColors.WARNING}What to send? To end list enter a single dot{ANSIColors.ENDC}\n.')
+        commands, s = [], ''
+        while s != '.':
+            s = input()
+            if s != '.':
+                commands.append(s)
+    else:
+        with open(os.path.expanduser(commands_file), 'r') as f:
+            commands = [line.rstrip('\n') for line in f]
+    if not commands:
+        print(f'{ANSIColors.FAIL}No commands.{ANSIColors.ENDC}')
+        return
+    prompt = input_prompt_regex()
+
+    def report(connection_type, host, pane_id, done, error):
+        if error is None:
+            print(f'{ANSIColors.OKGREEN}ok{ANSIColors.ENDC}   {connection_type} {host} ({pane_id})')
         else:
+            print(f'{ANSIColors.FAIL}fail{ANSIColors.ENDC} {connection_type} {host} ({pane_id}): {error}, '
+                  f'{done}/{len(commands)} commands done')
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        results = loop.run_until_complete(run_on_hosts_async(hosts, commands, prompt, settings, report))
+    finally:
+        loop.close()
+    failed = [result for result in results if result[4] is not None]
+    print(f'\n{ANSIColors.BOLD}{len(results) - len(failed)} succeeded, {len(failed)} failed.{ANSIColors.ENDC}')
+    for connection_type, host, pane_id, done, error in failed:
+        print(f'  {connection_type} {host}: {error}')
+
+
+# ssh options, that take an argument.
+SSH_ARGUMENT_OPTIONS = set('BbcDEeFIiJLlmOoPpQRSWw')
+
+
+def probe_target(connection_type, host):
+    """
+    Returns (hostname, port), that connection to host goes to, or None if it's not known. ssh host can be
+    ssh config alias and have user@ and -p port, telnet host can have port after it.
+    """
+    try:
+        arguments = shlex.split(host)
+    except ValueError:
+        return None
+    if connection_type == 'telnet':
+        if not arguments:
+            return None
+        port = int(arguments[1]) if len(arguments) > 1 and arguments[1].isdigit() else 23
+        return arguments[0], port
+    port, destination = None, None
+    arguments = iter(arguments)
+    for argument in arguments:
+        if argument.startswith('-') and len(argument) == 2 and argument[1] in SSH_ARGUMENT_OPTIONS:
+            value = next(arguments, '')
+            if argument == '-p' and value.isdigit():
+                port = int(value)
+        elif argument.startswith('-p') and argument[2:].isdigit():
+            port = int(argument[2:])
+        elif not argument.startswith('-'):
+            destination = argument
             break
+    if destination is None:
+        return None
+    destination = destination.rpartition('@')[2]
+    options = (ssh_config() or {}).get(destination, {})
+    if port is None:
+        port = options.get('port', 22)
+    return options.get('hostname', destination), port
+
+
+def probe_hosts_list(settings):
+    """
+    Returns hosts to check: recent hosts first, then ssh config hosts, not more than probe_max_hosts.
+    """
+    hosts = recent_sessions(load_sessions_metadata(), dict(settings, recent_sessions_menu=settings['probe_max_hosts']))
+    hosts += [('ssh', host) for host in ssh_config_hosts() or []]
+    return list(dict.fromkeys(hosts))[:settings['probe_max_hosts']]
+
+
+async def probe_hosts_async(targets, timeout, concurrency):
+    """
+    Tries TCP connection to every (hostname, port), not more than concurrency at once.
+    Returns {(hostname, port): round trip time in milliseconds or None if it's down}.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def probe(hostname, port):
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(hostname, port), timeout)
+            except (OSError, asyncio.TimeoutError):
+                return None
+            rtt = (time.monotonic() - started) * 1000
+            writer.close()
+            return rtt
+
+    rtts = await asyncio.gather(*(probe(hostname, port) for hostname, port in targets))
+    return dict(zip(targets, rtts))
+
+
+def probe_hosts(hosts_spec=None):
+    """
+    Checks reachability of hosts (see resolve_hosts for hosts_spec, by default recent and ssh config hosts)
+    and saves results to the reachability cache {"hostname:port": [up, rtt_ms, checked_time]}.
+    Results of other hosts, that are not older than probe_ttl, are kept.
+    """
+    settings = load_settings()
+    try:
+        hosts = resolve_hosts(hosts_spec) if hosts_spec else probe_hosts_list(settings)
+    except ValueError as exc:
+        print(exc)
+        return
+    targets = {}
+    for connection_type, host in hosts:
+        target = probe_target(connection_type, host)
+        if target is not None:
+            targets.setdefault(target, []).append(f'{connection_type} {host}')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        rtts = loop.run_until_complete(
+            probe_hosts_async(list(targets), settings['probe_timeout'], settings['probe_concurrency'])
+        )
+    finally:
+        loop.close()
+
+    now = time.time()
+    results = {key: value for key, value in load_reachability().items() if now - value[2] < settings['probe_ttl']}
+    for (hostname, port), rtt in rtts.items():
+        results[f'{hostname}:{port}'] = [rtt is not None, None if rtt is None else round(rtt, 1), round(now)]
+    write_file_atomic(lPaths.reachability, json.dumps(results), fsync=False)
+    if hosts_spec:
+        for (hostname, port), rtt in rtts.items():
+            if rtt is None:
+                status = f'{ANSIColors.FAIL}down{ANSIColors.ENDC}'
+            else:
+                status = f'{ANSIColors.OKGREEN}up{ANSIColors.ENDC} {rtt:.1f} ms'
+            print(f'{", ".join(targets[(hostname, port)])} ({hostname}:{port}): {status}')
+
+
+def load_reachability():
+    if not os.path.exists(lPaths.reachability):
+        return {}
+    return read_cached(lPaths.reachability, json.load)
+
+
+def reachability_label(connection_type, host, reachability, settings):
+    """
+    Returns label for menu item of the host from the reachability cache: " [up 12ms]", " [down]", or '' if
+    host wasn't checked recently. Only the cache is read, so menus are never delayed.
+    """
+    target = probe_target(connection_type, host)
+    result = reachability.get(f'{target[0]}:{target[1]}') if target is not None else None
+    if result is None or time.time() - result[2] >= settings['probe_ttl']:
+        return ''
+    if not result[0]:
+        return ' [down]'
+    return f' [up {round(result[1])}ms]'
+
+
+# Subcommands that daemon can run. Others are interactive, streaming or wait for devices (login, bulk_connect,
+# restore), and are run by noc_client.py itself: daemon runs one request at a time, and tmux hooks, that
+# wait for rename_window, would wait for them too.
+DAEMON_COMMANDS = {
+    'noc_menu',
+    'ssh_menu',
+    'clipboard_menu',
+    'move_pane_window',
+    'setup_connection',
+    'connect_telnet',
+    'connect_ssh',
+    'toggle_log',
+    'open_log',
+    'rename_window',
+    'rename_windows',
+    'snapshot',
+}
+# Environment variables, that noc_client.py sends with request. tmux uses them to find current session.
+DAEMON_REQUEST_ENV = ('TMUX', 'TMUX_PANE')
+
 
-    rows = subprocess.check_output(['stty', 'size']).decode().split()[0]
-    rows = int(rows) - 2
-    rows_offset = 0
-    for index, command in enumerate(commands):
-        subprocess.call('clear', shell=True)
-        if len(commands) > rows:
-            if index > 5:
-                rows_offset = index - 5
-        print('\n'.join(commands[rows_offset:index]))
-        print(f'{ANSIColors.OKGREEN}{ANSIColors.BOLD}{command}{ANSIColors.ENDC}')
-        print('\n'.join(commands[index + 1:rows + rows_offset]))
-
-        if character_delay > 0:
-            characters = list(command)
-            for character in characters:
-                tmux_send(character, '', pane_id)
-                time.sleep(character_delay / 1000)
-            tmux_send('', 'Enter', pane_id)
+def tmux_server_alive(tmux_env):
+    """
+    Check if tmux server from TMUX environment variable ("socket_path,pid,session") is still running.
+    """
+    try:
+        os.kill(int(tmux_env.split(',')[1]), 0)
+    except (IndexError, ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def handle_daemon_request(connection, parser):
+    """
+    Runs one subcommand, received from noc_client.py, and sends back it's output and exit status.
+    Request is one line of json: {"argv": [...], "env": {...}}.
+    """
+    with connection, connection.makefile('rwb') as stream:
+        request = json.loads(stream.readline())
+        argv = request['argv']
+        if not argv or argv[0] not in DAEMON_COMMANDS:
+            response = {'fallback': True}
         else:
-            tmux_send(command, target_pane=pane_id)
-        if not index + 1 == len(commands):
-            time.sleep(line_delay / 1000)
+            for name in DAEMON_REQUEST_ENV:
+                if name in request['env']:
+                    os.environ[name] = request['env'][name]
+                else:
+                    os.environ.pop(name, None)
+            get_tmux_transport().reset_context()
+            output = io.StringIO()
+            status = 0
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                try:
+                    run_command(parser.parse_args(argv))
+                except SystemExit as exc:
+                    status = exc.code if isinstance(exc.code, int) else 1
+                except Exception as exc:
+                    print(f'{type(exc).__name__}: {exc}')
+                    status = 1
+            response = {'status': status, 'output': output.getvalue()}
+        stream.write(json.dumps(response).encode() + b'\n')
 
 
-if __name__ == "__main__":
-    create_dir(f'{lPaths.tmuxNOC}/local/')
+def run_daemon():
+    """
+    Resident process, that runs subcommands sent by noc_client.py through unix socket. Parsed metadata,
+    ssh config and logins stay in memory between requests. Exits with tmux server, that started it.
+    Logs compaction is started in the background with the lowest priority every log_compact_interval,
+    hosts reachability check every probe_interval, snapshot of windows is saved every snapshot_interval.
+    Menus are rendered again after every request and every timeout, if ssh config, settings, sessions metadata
+    or reachability have changed, so new recent sessions are in the menu right after connection.
+    """
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(lPaths.daemon_socket)
+        return
+    except OSError:
+        if os.path.exists(lPaths.daemon_socket):
+            os.remove(lPaths.daemon_socket)
+    finally:
+        probe.close()
+
+    tmux_env = os.environ.get('TMUX', '')
+    script_mtime = os.stat(lPaths.script).st_mtime_ns
+    parser = build_parser(stdin=None)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    server.bind(lPaths.daemon_socket)
+    os.umask(old_umask)
+    server.listen(16)
+    # Timeout is how often ssh config is checked for changes of pre-rendered menus.
+    server.settimeout(5)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    signal.signal(signal.SIGHUP, lambda *_: sys.exit(0))
+    menus_state['daemon'] = True
+    compaction, next_compaction = None, time.monotonic() + 60
+    prober, next_probe = None, time.monotonic()
+    next_snapshot = time.monotonic()
+    try:
+        while not tmux_env or tmux_server_alive(tmux_env):
+            update_menus()
+            snapshot_interval = load_settings()['snapshot_interval']
+            if snapshot_interval and time.monotonic() >= next_snapshot:
+                update_snapshot()
+                next_snapshot = time.monotonic() + snapshot_interval
+            if prober is not None and prober.poll() is not None:
+                prober = None
+            probe_interval = load_settings()['probe_interval']
+            if prober is None and probe_interval and time.monotonic() >= next_probe:
+                prober = subprocess.Popen([sys.executable, lPaths.script, 'probe_hosts'],
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                next_probe = time.monotonic() + probe_interval
+            if compaction is not None and compaction.poll() is not None:
+                compaction = None
+            if compaction is None and time.monotonic() >= next_compaction:
+                compaction = subprocess.Popen(
+                    ['nice', '-n', '19', sys.executable, lPaths.script, 'compact_logs'],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+                )
+                next_compaction = time.monotonic() + load_settings()['log_compact_interval']
+            try:
+                connection, _ = server.accept()
+            except socket.timeout:
+                continue
+            connection.settimeout(None)
+            if os.stat(lPaths.script).st_mtime_ns != script_mtime:
+                # Script was updated. Let the client run the new version and restart the daemon with it.
+                # Request is read first: closing socket with unread data resets the connection.
+                with connection, connection.makefile('rwb') as stream:
+                    stream.readline()
+                    stream.write(json.dumps({'fallback': True}).encode() + b'\n')
+                server.close()
+                os.remove(lPaths.daemon_socket)
+                os.execv(sys.executable, [sys.executable, lPaths.script, 'daemon'])
+            try:
+                handle_daemon_request(connection, parser)
+            except (OSError, ValueError, KeyError):
+                continue
+    finally:
+        server.close()
+        if os.path.exists(lPaths.daemon_socket):
+            os.remove(lPaths.daemon_socket)
+        invalidate_menus()
+
+
+def build_parser(stdin=sys.stdin):
     parser = argparse.ArgumentParser(description='Connect to telnet or ssh from tmux.')
     parser.add_argument('type', choices=[
         'login',
@@ -728,6 +4041,21 @@ if __name__ == "__main__":
         'open_log',
         'rename_window',
         'rename_windows',
+        'daemon',
+        'rebuild_log_index',
+        'index_logs',
+        'grep_logs',
+        'compact_logs',
+        'sessions_history',
+        'find_host',
+        'run_on_hosts',
+        'bulk_connect',
+        'stats',
+        'log_commands',
+        'probe_hosts',
+        'ssh_pool',
+        'snapshot',
+        'restore',
     ])
     parser.add_argument('--login_number', nargs='?')
     parser.add_argument('--host', nargs='?')
@@ -740,19 +4068,42 @@ if __name__ == "__main__":
         '-i',
         '--input',
         type=argparse.FileType('r'),
-        default=(None if sys.stdin.isatty() else sys.stdin)
+        default=(None if stdin is None or stdin.isatty() else stdin)
     )
     parser.add_argument('--history_index', nargs='?')
-    args = parser.parse_args()
+    parser.add_argument('--query', nargs='?')
+    parser.add_argument('--group', nargs='?')
+    parser.add_argument('--page', nargs='?')
+    parser.add_argument('--hosts', nargs='?')
+    parser.add_argument('--at', nargs='?')
+    parser.add_argument('--command', nargs='?')
+    parser.add_argument('--prune', action='store_true')
+    parser.add_argument('--name', nargs='?')
+    return parser
+
+
+def run_command(args):
+    """
+    Runs subcommand. If tracing is enabled, subcommand is traced and trace is written at the end.
+    """
+    trace_state['enabled'] = None
+    try:
+        with trace_span('command', args.type):
+            dispatch_command(args)
+    finally:
+        if trace_state['spans']:
+            flush_trace()
 
+
+def dispatch_command(args):
     if args.type == 'login':
-        send_login_pwd(args.login_number)
+        send_login_pwd(args.login_number, args.pane_id)
     elif args.type == 'send_with_delay':
         send_with_delay(args.pane_id)
     elif args.type == 'noc_menu':
         noc_menu(args.split_direction)
     elif args.type == 'ssh_menu':
-        ssh_menu(args.split_direction)
+        ssh_menu(args.split_direction, args.group, args.page)
     elif args.type == 'clipboard_menu':
         clipboard_menu(args.split_direction)
     elif args.type == 'move_pane_window':
@@ -760,9 +4111,9 @@ if __name__ == "__main__":
     elif args.type == 'setup_connection':
         setup_connection(args.connection_type, args.split_direction)
     elif args.type == 'connect_telnet':
-        connect_telnet(args.host, args.split_direction)
+        connect_telnet(args.host, args.split_direction, pane_id=args.pane_id)
     elif args.type == 'connect_ssh':
-        connect_ssh(args.host, args.split_direction)
+        connect_ssh(args.host, args.split_direction, pane_id=args.pane_id)
     elif args.type == 'toggle_log':
         pane_log('l', 'local')
     elif args.type == 'save_pane_history':
@@ -770,8 +4121,53 @@ if __name__ == "__main__":
     elif args.type == 'search_logs':
         search_logs()
     elif args.type == 'open_log':
-        open_log(args.history_index, args.split_direction)
+        open_log(args.history_index, args.split_direction, args.at)
     elif args.type == 'rename_window':
         rename_window(args.window_id)
     elif args.type == 'rename_windows':
         rename_windows()
+    elif args.type == 'daemon':
+        run_daemon()
+    elif args.type == 'rebuild_log_index':
+        print(f'{rebuild_log_index()} log files indexed.')
+    elif args.type == 'grep_logs':
+        words, filters, regex = parse_search_query(args.query or '')
+        limit = load_settings()['search_limit']
+        for result in grep_logs(regex if regex is not None else re.escape(' '.join(words)), filters, limit):
+            print(result)
+    elif args.type == 'bulk_connect':
+        bulk_connect(args.hosts)
+    elif args.type == 'stats':
+        trace_stats()
+    elif args.type == 'snapshot':
+        snapshot(args.name)
+    elif args.type == 'restore':
+        restore_snapshot(args.name)
+    elif args.type == 'ssh_pool':
+        ssh_pool(args.prune)
+    elif args.type == 'probe_hosts':
+        probe_hosts(args.hosts)
+    elif args.type == 'log_commands':
+        log_commands(args.history_index, args.command)
+    elif args.type == 'run_on_hosts':
+        run_on_hosts(args.hosts, args.file_name)
+    elif args.type == 'find_host':
+        find_host()
+    elif args.type == 'sessions_history':
+        sessions_history()
+    elif args.type == 'compact_logs':
+        compressed, deleted = compact_logs()
+        print(f'{compressed} log files compressed, {deleted} log files deleted.')
+    elif args.type == 'index_logs':
+        connection = log_search_connection()
+        if connection is None:
+            print('SQLite is built without FTS5, logs can\'t be indexed.')
+        else:
+            with contextlib.closing(connection):
+                index_logs(connection, progress=True)
+
+
+if __name__ == "__main__":
+    create_dir(f'{lPaths.tmuxNOC}/local/')
+    trace_startup()
+    run_command(build_parser().parse_args())